@@ -4,8 +4,9 @@
 它是一个需要登陆宣泄心声的树洞，无需登陆即可查看他人心声(get去掉login_required)，但提供私密选项仅自己可见...
 """
 from app import create_app
+import os
 
-app = create_app()
+app = create_app(os.environ.get('KODAMACY_DATA'))  # 设置该环境变量以持久化数据
 
 
 @app.route('/')
@@ -1,11 +1,16 @@
 from pprika import PPrika
+from .storage import Storage
 
 db = {'voices': [], 'users': {}, 'g': {}}
-# todo 换个真正的数据库
+storage = Storage(db)  # db的持久化，修改db都应经过 storage.apply
 # todo 如reqparse般方便的参数验证
 
 
-def create_app():
+def create_app(data_dir=None):
+    """data_dir：持久化数据所在目录，为None时数据只存于内存"""
+    if data_dir is not None:
+        storage.open(data_dir)
+
     app = PPrika()
     from .v1 import v1
     app.register_blueprint(v1)
@@ -55,3 +55,15 @@ class NotLogin(CustomException):
     code = 1004
     status = 401
     message = "未登录或登录信息错误"
+
+
+class TooManyRequests(CustomException):
+    code = 3001
+    status = 429
+    message = "请求过于频繁，请稍后再试"
+
+
+class StorageUnavailable(CustomException):
+    code = 3002
+    status = 503
+    message = "数据暂时无法保存，请稍后再试"
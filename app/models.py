@@ -0,0 +1,6 @@
+from pprika import make_record
+
+User = make_record('User', ('name', 'uid', 'password'))
+
+Voice = make_record('Voice', ('voice', 'private', 'date', 'uname', 'vid'))
+# voice长期存于db中，以__slots__记录代替Namespace节省内存
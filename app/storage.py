@@ -0,0 +1,211 @@
+"""
+db 的持久化：快照 + 追加写日志
+所有修改经 storage.apply 进行，先作用于内存中的db，再追加到日志的待写队列，
+后台线程成批写入并 fsync(组提交)，且定期生成快照、删除快照之前的日志
+启动时以mmap读取快照，再重放其后的日志，重启耗时取决于快照大小与快照间隔
+"""
+from .models import User, Voice
+from .exception import StorageUnavailable
+from threading import Lock, Condition, Thread
+from mmap import mmap, ACCESS_READ
+from zlib import crc32
+from time import monotonic
+from traceback import print_exc
+import marshal
+import struct
+import atexit
+import os
+
+_header = struct.Struct('<II')  # (长度, crc32)
+
+
+def _apply(db, op, args):
+    """将一条操作作用于db，重放日志时同样调用；'voice=' 以整条记录覆盖，重复执行结果不变"""
+    if op == 'user':
+        name, user = args
+        db['users'][name] = user if isinstance(user, User) else User(**user)
+    elif op == 'voice+':
+        voice, = args
+        db['voices'].append(voice if isinstance(voice, Voice) else Voice(**voice))
+    elif op == 'voice=':
+        index, voice = args
+        db['voices'][index] = voice if isinstance(voice, Voice) else Voice(**voice)
+    elif op == 'voice-':
+        index, = args
+        db['voices'].pop(index)
+    else:
+        raise ValueError(f'未知的操作: {op}')
+
+
+def _encode(op, args):
+    args = tuple(a.to_dict() if hasattr(a, 'to_dict') else a for a in args)
+    payload = marshal.dumps((op, args))
+    return _header.pack(len(payload), crc32(payload)) + payload
+
+
+class Storage(object):
+    """
+    用法：storage = Storage(db)，storage.open(directory) 后以 storage.apply('voice+', voice) 代替直接修改db
+    未open时apply只修改内存，不做持久化
+
+    fsync_interval：组提交间隔(秒)，同一间隔内的写入合并为一次write+fsync
+    snapshot_interval / snapshot_ops：距上次快照的时间或操作数超过其一即生成新快照
+
+    后台线程写盘或生成快照出错(如磁盘已满)时输出错误并停止，之后的apply都抛出 StorageUnavailable(503)，
+    不再修改db；正在等待fsync的 apply(sync=True) 同样抛出，需排除故障后重启
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.directory = None
+        self._pending = []  # 待写入日志的记录
+        self._ops = 0  # 上次快照后的操作数
+        self._lock = Lock()
+        self._cond = Condition(self._lock)
+        self._log = None
+        self._seq = 0  # 当前日志序号，快照记录其生成时对应的序号
+        self._closed = False
+        self._synced = 0  # 已fsync的批次号
+        self._batch = 0
+        self._error = None  # 后台线程出错时的异常
+
+    def open(self, directory, fsync_interval=0.05, snapshot_interval=600, snapshot_ops=100000):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.snapshot_interval = snapshot_interval
+        self.snapshot_ops = snapshot_ops
+
+        self._recover()
+        self._log = open(self._log_path(self._seq), 'ab')
+        self._last_snapshot = monotonic()
+        Thread(target=self._run, name='kodamacy-storage', daemon=True).start()
+        atexit.register(self.close)
+
+    def _log_path(self, seq):
+        return os.path.join(self.directory, f'log.{seq:08d}')
+
+    def _log_seqs(self):
+        names = (n for n in os.listdir(self.directory) if n.startswith('log.'))
+        return sorted(int(n[4:]) for n in names if n[4:].isdigit())
+
+    def _recover(self):
+        """加载快照并重放其后的日志，日志末尾不完整的记录(写入时崩溃)被截去"""
+        path = os.path.join(self.directory, 'snapshot')
+        if os.path.exists(path) and os.path.getsize(path):
+            with open(path, 'rb') as f, mmap(f.fileno(), 0, access=ACCESS_READ) as mm:
+                snapshot = marshal.loads(mm)
+            self._seq = snapshot['seq']
+            self.db['users'].update((u['name'], User(**u)) for u in snapshot['users'])
+            self.db['voices'][:] = [Voice(**v) for v in snapshot['voices']]
+
+        for seq in self._log_seqs():
+            if seq >= self._seq:
+                self._replay(self._log_path(seq))
+                self._seq = seq
+
+    def _replay(self, path):
+        with open(path, 'rb+') as f:
+            data = f.read()
+            offset = 0
+            while offset + _header.size <= len(data):
+                length, checksum = _header.unpack_from(data, offset)
+                payload = data[offset + _header.size:offset + _header.size + length]
+                if len(payload) < length or crc32(payload) != checksum:
+                    break
+                op, args = marshal.loads(payload)
+                _apply(self.db, op, args)
+                offset += _header.size + length
+            if offset < len(data):
+                f.truncate(offset)
+
+    def apply(self, op, *args, sync=False):
+        """
+        修改db并记录到日志，O(1)，不等待写盘
+        sync为True时等到该记录fsync完成才返回
+        """
+        with self._lock:
+            if self._error is not None:
+                raise StorageUnavailable()
+            _apply(self.db, op, args)
+            if self._log is None:
+                return
+            self._pending.append(_encode(op, args))
+            self._ops += 1
+            batch = self._batch
+            if sync:
+                self._cond.notify_all()
+                while self._synced <= batch and not self._closed and self._error is None:
+                    self._cond.wait()
+                if self._synced <= batch and self._error is not None:
+                    raise StorageUnavailable()
+
+    def _flush(self):
+        """写入并fsync待写记录，调用时需持有锁"""
+        if self._pending:
+            self._log.write(b''.join(self._pending))
+            self._pending.clear()
+            self._log.flush()
+            os.fsync(self._log.fileno())
+        self._batch += 1
+        self._synced = self._batch
+        self._cond.notify_all()
+
+    def _run(self):
+        try:
+            while True:
+                with self._lock:
+                    self._cond.wait(self.fsync_interval)
+                    if self._closed:
+                        return
+                    self._flush()
+                    due = (self._ops >= self.snapshot_ops
+                           or self._ops and monotonic() - self._last_snapshot >= self.snapshot_interval)
+                if due:
+                    self.snapshot()
+        except Exception as e:  # 出错后日志文件的状态未知，不再写入
+            print_exc()
+            with self._lock:
+                self._error = e
+                self._cond.notify_all()
+
+    def snapshot(self):
+        """
+        在锁内切换到新日志并复制db的结构，之后在锁外序列化并原子替换快照文件
+        快照期间对记录字段的修改可能已含在快照中，其日志重放时以整条覆盖，结果一致
+        """
+        with self._lock:
+            self._flush()
+            self._log.close()
+            self._seq += 1
+            self._log = open(self._log_path(self._seq), 'ab')
+            seq, self._ops = self._seq, 0
+            users, voices = list(self.db['users'].values()), list(self.db['voices'])
+
+        data = marshal.dumps({
+            'seq': seq,
+            'users': [u.to_dict() for u in users],
+            'voices': [v.to_dict() for v in voices],
+        })
+        path = os.path.join(self.directory, 'snapshot')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        for old in self._log_seqs():
+            if old < seq:
+                os.remove(self._log_path(old))
+        self._last_snapshot = monotonic()
+
+    def close(self):
+        with self._lock:
+            if self._log is None or self._closed:
+                return
+            if self._error is None:
+                self._flush()
+            self._closed = True
+            self._log.close()
+            self._log = None  # 之后的apply只修改内存
+            self._cond.notify_all()
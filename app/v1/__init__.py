@@ -1,11 +1,14 @@
 from pprika import Api
+from pprika import Envelope
+from pprika import Idempotency
+from pprika.limiter import header
 from ..exception import CustomException
 
-v1 = Api('v1', url_prefix='/v1', exception_cls=CustomException)
+v1 = Api('v1', url_prefix='/v1', exception_cls=CustomException, envelope=Envelope({'code': 0, 'msg': ''}))
+# 视图函数只需返回data部分，由envelope统一套上 {'code': 0, 'msg': '', 'data': ...}
 
-
-def response(data):
-    return {'code': 0, 'msg': '', 'data': data}
+idempotent = Idempotency(key_func=header('AuthToken'))
+# 客户端重试POST时带上相同的 Idempotency-Key，避免重复注册、重复发表
 
 
 from . import user, voice
@@ -1,23 +1,29 @@
-from . import v1, response
+from . import v1, idempotent
 from ..exception import LackOfInfo
 from ..exception import UserAlreadyExist
 from ..exception import NotFound
 from ..exception import PwdError
-from .. import db
+from ..exception import TooManyRequests
+from .. import db, storage
+from ..models import User
 from ..auth import generate_token
 from pprika import Resource
 from pprika import RequestParser
+from pprika import RateLimiter
 
 
 reqparse = RequestParser()
 reqparse.add_argument('name', type=str, required=True, location=['json', 'headers'])
 reqparse.add_argument('password', dest='pwd', type=str, required=True, location=['json', 'headers'])
 
+login_limiter = RateLimiter(10, per=60, exception_cls=TooManyRequests)  # 每ip每分钟10次，防止爆破密码
+
 
 class Register(Resource):
     def __init__(self):
         self.reqparse = reqparse
 
+    @idempotent
     def post(self):
         args = self.reqparse.parse_args(strict=True)
 
@@ -26,14 +32,15 @@ class Register(Resource):
         if args.name in db['users']:
             raise UserAlreadyExist()
 
-        args.uid = len(db['users']) + 1
-        args.password = args.pop('pwd')
-        db['users'][args.name] = args
+        user = User(name=args.name, uid=len(db['users']) + 1, password=args.pwd)
+        storage.apply('user', user.name, user)
 
-        return response(args)
+        return user
 
 
 class Login(Resource):
+    decorators = [login_limiter]
+
     def __init__(self):
         self.reqparse = reqparse
 
@@ -46,11 +53,11 @@ class Login(Resource):
         if args.name not in db['users']:
             raise NotFound('不存在该用户，请先注册')
 
-        if args.pwd != db['users'][args.name]['password']:
+        if args.pwd != db['users'][args.name].password:
             raise PwdError()
 
         token = generate_token(args.name)
-        return response(token)
+        return token
 
 
 v1.add_resource(Register, '/users/register')
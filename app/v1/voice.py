@@ -1,12 +1,19 @@
-from . import v1, response
-from .. import db
+from . import v1, idempotent
+from .. import db, storage
+from ..models import Voice as VoiceRecord
 from datetime import datetime
 from ..exception import ForbiddenWord
 from ..exception import NotFound
 from ..exception import PrivateVoice
-from ..auth import login_required
+from ..exception import TooManyRequests
+from ..auth import login_required, verify_token
+from ..wordfilter import WordFilter
 from pprika import Resource
+from pprika import request
 from pprika import RequestParser
+from pprika import RateLimiter
+from pprika import Broker
+import os
 
 """
 request:
@@ -24,6 +31,17 @@ uname: 发言者name
 
 # todo 还需要一个get所有自身发过的voice的api(包括私密)
 
+word_filter = WordFilter.from_file(os.path.join(os.path.dirname(__file__), '..', 'sensitive_words.txt'))
+# 敏感词表，修改文件后自动生效
+
+voice_broker = Broker()
+# 新发表的(非私密)voice经此推送给 VoiceStream 的订阅者，代替轮询
+
+post_limiter = RateLimiter(5, per=60, key_func=lambda: verify_token(request.headers.get('AuthToken')),
+                           exception_cls=TooManyRequests)
+# 每个用户每分钟至多发表5条voice，需在login_required之后执行
+# 用户取自本次请求的token而非 db['g']['user']，后者为各请求线程共享，可能已被并发的请求覆盖
+
 
 class VoiceList(Resource):
     decorators = [login_required]
@@ -34,13 +52,17 @@ class VoiceList(Resource):
     def get(self):
         self.reqparse.add_argument('vid', type=int, default=-1, location='args')
         self.reqparse.add_argument('ps', type=int, default=3, location='args')
+        self.reqparse.add_argument('vids', type=list[int], location='args', max_items=50)
         args = self.reqparse.parse_args(strict=True)
         vid, ps = args['vid'], args['ps']
 
         voices = db.get('voices', [])
         v_len = len(voices)
 
-        if vid == -1:  # 第一次请求得知当前时间点往前的历史消息数，不返回消息
+        if args.vids:  # 一次按编号批量获取，不存在或私密的voice会被跳过
+            v_list = [voices[v-1] for v in args.vids if 0 < v <= v_len]
+            data = {'voices': [v for v in v_list if not v.private]}
+        elif vid == -1:  # 第一次请求得知当前时间点往前的历史消息数，不返回消息
             data = {'left': v_len, 'voices': []}  # left: 剩余未取数量
         else:
             vid = v_len-1 if vid > v_len else 0 if vid < 0 else vid-1  # -2<vid<v_len, 与begin相对，充当end
@@ -48,25 +70,37 @@ class VoiceList(Resource):
             data = {'left': begin, 'voices': []}
 
             v_list = voices[begin:vid+1]
-            v_list = [v for v in v_list if not v['private']]  # 隐私项会被过滤
+            v_list = [v for v in v_list if not v.private]  # 隐私项会被过滤
             data['voices'] = v_list[::-1]  # left=begin=0说明获取完毕
 
-        return response(data)
+        return data
 
+    @idempotent
+    @post_limiter
     def post(self):
         self.reqparse.add_argument('voice', type=str, required=True, location='json')
         self.reqparse.add_argument('private', type=int, default=0, location='json')
-        data = self.reqparse.parse_args(strict=True)
+        data = self.reqparse.parse_args(strict=True, record_cls=VoiceRecord)
 
-        if '敏感词汇' in data.voice:
+        if word_filter.contains(data.voice):
             raise ForbiddenWord()
 
-        data['date'] = str(datetime.now())
-        data['uname'] = db['g']['user']['name']
-        db['voices'].append(data)
+        data.date = str(datetime.now())
+        data.uname = db['g']['user'].name
+        data.vid = len(db['voices']) + 1
+        storage.apply('voice+', data)
+
+        if not data.private:
+            voice_broker.publish(data, event='voice')
+        return data, 201
 
-        data['vid'] = len(db['voices'])
-        return response(data), 201
+
+class VoiceStream(Resource):
+    decorators = [login_required]  # 与VoiceList.get一致，仅登录用户可订阅
+
+    def get(self):
+        """Server-Sent Events，每有新voice就推送一条，断线重连时浏览器会带上 Last-Event-ID 补回"""
+        return voice_broker.stream()
 
 
 class Voice(Resource):
@@ -81,10 +115,10 @@ class Voice(Resource):
         except IndexError:
             raise NotFound('不存在该vid对应的voice')
 
-        if voice['private'] and voice['uname'] != db['g']['user']['name']:
+        if voice.private and voice.uname != db['g']['user'].name:
             raise PrivateVoice()
 
-        return response(voice), 200
+        return voice, 200
 
     def put(self, vid):
         reqparse = RequestParser()
@@ -99,14 +133,15 @@ class Voice(Resource):
         except IndexError:
             raise NotFound('不可修改不存在的voice')
 
-        if voice['uname'] != db['g']['user']['name']:
+        if voice.uname != db['g']['user'].name:
             raise PrivateVoice('不可修改其他用户的voice')
 
         data = voices[vid]
-        data['date'] = str(datetime.now())
+        data.date = str(datetime.now())
         data.update(args)
+        storage.apply('voice=', vid, data)
 
-        return response(data), 200
+        return data, 200
 
     def delete(self, vid):
         vid -= 1
@@ -117,12 +152,13 @@ class Voice(Resource):
         except IndexError:
             raise NotFound('不可删除不存在的voice')
 
-        if voice['uname'] != db['g']['user']['name']:
+        if voice.uname != db['g']['user'].name:
             raise PrivateVoice('不可删除其他用户的voice')
 
-        voice = voices.pop(vid)
-        return response(voice), 200
+        storage.apply('voice-', vid)
+        return voice, 200
 
 
 v1.add_resource(VoiceList, '/voices')
 v1.add_resource(Voice, '/voices/<int:vid>')
+v1.add_resource(VoiceStream, '/voices/stream')
@@ -0,0 +1,157 @@
+"""
+基于 Aho–Corasick 自动机的多模式敏感词过滤，扫描耗时只与文本长度有关，与词表大小无关
+词表可从文件热加载：文件修改后在下一次扫描时重建自动机并整体替换，扫描中的请求不受影响
+"""
+from collections import deque
+from threading import Lock
+from time import monotonic
+import os
+
+
+def _to_halfwidth(text):
+    """全角字符转半角并转小写，逐字符转换，不改变文本长度，匹配位置仍对应原文"""
+    chars = []
+    for ch in text:
+        code = ord(ch)
+        if code == 0x3000:
+            ch = ' '
+        elif 0xFF01 <= code <= 0xFF5E:
+            ch = chr(code - 0xFEE0)
+        lower = ch.lower()
+        chars.append(lower if len(lower) == 1 else ch)  # 如 'İ'.lower() 为两个字符，保持原样
+    return ''.join(chars)
+
+
+def _build(words):
+    """构建自动机，返回 (goto, fail, output)，output[state]为在该状态结束的词长元组"""
+    goto, fail, output = [{}], [0], [()]
+
+    for word in words:
+        state = 0
+        for ch in word:
+            nxt = goto[state].get(ch)
+            if nxt is None:
+                nxt = goto[state][ch] = len(goto)
+                goto.append({})
+                fail.append(0)
+                output.append(())
+            state = nxt
+        output[state] = (len(word),)
+
+    queue = deque(goto[0].values())
+    while queue:  # 广度优先求失败指针，并合并失败链上的输出
+        state = queue.popleft()
+        for ch, nxt in goto[state].items():
+            queue.append(nxt)
+            f = fail[state]
+            while f and ch not in goto[f]:
+                f = fail[f]
+            fail[nxt] = goto[f].get(ch, 0)
+            output[nxt] = output[nxt] + output[fail[nxt]]
+
+    return goto, fail, output
+
+
+class WordFilter(object):
+    """
+    用法：
+    word_filter = WordFilter.from_file('sensitive_words.txt')
+    word_filter.contains(text) / word_filter.scan(text)
+
+    normalize：是否忽略全角/半角与大小写的差别
+    reload_interval：从文件加载时，检查文件是否修改的最小间隔(秒)
+    """
+
+    def __init__(self, words=(), normalize=True):
+        self.normalize = normalize
+        self.path = None
+        self.reload_interval = None
+        self._mtime = None
+        self._checked = 0
+        self._lock = Lock()
+        self.load(words)
+
+    @classmethod
+    def from_file(cls, path, normalize=True, reload_interval=5):
+        """从文件加载词表，每行一个词，空行与 # 开头的行被忽略"""
+        word_filter = cls(normalize=normalize)
+        word_filter.path = path
+        word_filter.reload_interval = reload_interval
+        word_filter.reload()
+        return word_filter
+
+    def load(self, words):
+        """以新词表重建自动机，并整体替换旧的"""
+        if self.normalize:
+            words = (_to_halfwidth(w) for w in words)
+        words = {w for w in words if w}
+        self._automaton = _build(words)  # 单次赋值，扫描中的线程仍使用旧自动机
+        self.size = len(words)
+
+    def reload(self):
+        """文件已修改时重新加载，返回是否重新加载"""
+        mtime = os.stat(self.path).st_mtime
+        if mtime == self._mtime:
+            return False
+
+        with open(self.path, encoding='utf-8') as f:
+            words = [w for w in (line.strip() for line in f) if not w.startswith('#')]
+        self.load(words)
+        self._mtime = mtime
+        return True
+
+    def _maybe_reload(self):
+        if self.path is None or monotonic() - self._checked < self.reload_interval:
+            return
+        if self._lock.acquire(blocking=False):  # 只需一个线程检查
+            try:
+                self._checked = monotonic()
+                self.reload()
+            except OSError:
+                pass  # 文件暂时不可读时继续使用旧词表
+            finally:
+                self._lock.release()
+
+    def scan(self, text):
+        """返回所有匹配 [(start, end, 原文中的词)]，位置可直接用于切片原文"""
+        self._maybe_reload()
+        goto, fail, output = self._automaton
+        target = _to_halfwidth(text) if self.normalize else text
+
+        matches = []
+        state = 0
+        for i, ch in enumerate(target):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            for length in output[state]:
+                matches.append((i - length + 1, i + 1, text[i - length + 1:i + 1]))
+        return matches
+
+    def contains(self, text):
+        """是否含有任一敏感词，找到第一个即返回"""
+        self._maybe_reload()
+        goto, fail, output = self._automaton
+        target = _to_halfwidth(text) if self.normalize else text
+
+        state = 0
+        for ch in target:
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if output[state]:
+                return True
+        return False
+
+    def validator(self, type=str):
+        """
+        生成可用作 Argument(type=...) 的转换函数，含敏感词时以ValueError报告参数错误
+        如：reqparse.add_argument('voice', type=word_filter.validator())
+        """
+        def convert(value):
+            value = type(value)
+            matches = self.scan(value)
+            if matches:
+                raise ValueError('包含敏感词: %s' % ', '.join(sorted({m[2] for m in matches})))
+            return value
+        return convert
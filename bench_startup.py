@@ -0,0 +1,69 @@
+"""
+测量冷启动耗时：每项在新的python进程中运行，取多次中的最小值
+python bench_startup.py [--apis 20] [--resources 50] [--repeat 5]
+"""
+from argparse import ArgumentParser
+from tempfile import TemporaryDirectory
+import subprocess
+import sys
+import os
+
+IMPORT = '''
+from time import perf_counter
+t = perf_counter()
+{stmt}
+print(perf_counter() - t)
+'''
+
+BUILD = '''
+from time import perf_counter
+t = perf_counter()
+from pprika import PPrika, Api, Resource, RouteCache
+app = PPrika()
+if {cache_dir!r}:
+    app.route_cache = RouteCache({cache_dir!r})
+for a in range({apis}):
+    api = Api(f'api{{a}}', url_prefix=f'/api{{a}}')
+    for r in range({resources}):
+        resource = type(f'R{{r}}', (Resource,), {{'get': lambda self, oid: {{}}, 'post': lambda self, oid: {{}}}})
+        api.add_resource(resource, f'/res{{r}}/<int:oid>/items', endpoint=f'r{{r}}')
+    app.register_blueprint(api)
+app.freeze()
+print(perf_counter() - t)
+'''
+
+
+def measure(code, repeat):
+    env = dict(os.environ, PYTHONPATH=os.path.dirname(os.path.abspath(__file__)))
+    times = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], env=env, check=True, capture_output=True, text=True)
+        times.append(float(out.stdout.strip().splitlines()[-1]))
+    return min(times)
+
+
+def main():
+    parser = ArgumentParser()
+    parser.add_argument('--apis', type=int, default=20)
+    parser.add_argument('--resources', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    build = dict(apis=args.apis, resources=args.resources)
+    rows = [
+        ('import pprika', measure(IMPORT.format(stmt='import pprika'), args.repeat)),
+        ('from pprika import PPrika, Api', measure(IMPORT.format(stmt='from pprika import PPrika, Api'), args.repeat)),
+        ('build + freeze', measure(BUILD.format(cache_dir='', **build), args.repeat)),
+    ]
+    with TemporaryDirectory() as cache_dir:
+        code = BUILD.format(cache_dir=cache_dir, **build)
+        rows.append(('build + freeze, route cache cold', measure(code, 1)))
+        rows.append(('build + freeze, route cache warm', measure(code, args.repeat)))
+
+    print(f'{args.apis} Api x {args.resources} Resource')
+    for name, seconds in rows:
+        print(f'{name:<36}{seconds * 1000:>10.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,48 @@
-from .app import PPrika
-from .context import request
-from .helpers import compact_dumps
-from .helpers import make_response
-from .blueprint import Blueprint
-from .restful import Api
-from .restful import ApiException
-from .restful import Resource
-from .restful import RequestParser
-from werkzeug.exceptions import abort
+"""
+各名称在首次访问时才导入所在模块(PEP 562)，import pprika 本身几乎没有开销
+如 from pprika import PPrika 只导入 pprika.app 及其依赖，不会导入profiler、sse等模块
+"""
+from importlib import import_module
+
+_exports = {
+    'PPrika': '.app',
+    'request': '.context',
+    'current_app': '.context',
+    'compact_dumps': '.helpers',
+    'make_response': '.helpers',
+    'send_file': '.helpers',
+    'Envelope': '.helpers',
+    'head_response': '.helpers',
+    'Blueprint': '.blueprint',
+    'Api': '.restful',
+    'ApiException': '.restful',
+    'Resource': '.restful',
+    'RequestParser': '.restful',
+    'make_record': '.restful',
+    'RateLimiter': '.limiter',
+    'Profiler': '.profiler',
+    'Broker': '.sse',
+    'Idempotency': '.idempotency',
+    'Cache': '.cache',
+    'SharedMemoryCache': '.cache',
+    'Logger': '.logger',
+    'RouteCache': '.routing',
+    'gather': '.concurrency',
+    'Cors': '.cors',
+    'abort': 'werkzeug.exceptions',
+}
+
+__all__ = list(_exports)
+
+
+def __getattr__(name):
+    module = _exports.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(import_module(module, __name__), name)
+    globals()[name] = value  # 之后的访问不再经过 __getattr__
+    return value
+
+
+def __dir__():
+    return sorted(list(globals()) + __all__)
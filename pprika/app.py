@@ -1,12 +1,18 @@
-from werkzeug.serving import run_simple
-from werkzeug.routing import Map, Rule
+from werkzeug.routing import Map
 from .context import RequestContext, request
-from .helpers import make_response
+from .routing import CachedRule
+from .helpers import make_response, fast_response, response_parts, RawResponse, _status_line
+from .restful import ApiException
 from werkzeug.exceptions import default_exceptions
 from werkzeug.exceptions import HTTPException
 from werkzeug.exceptions import InternalServerError
+from werkzeug.exceptions import GatewayTimeout, ServiceUnavailable, MethodNotAllowed
+from inspect import iscoroutine
 from sys import exc_info
+from threading import Lock
 from traceback import print_exception
+from time import perf_counter
+from hashlib import sha1
 
 
 class PPrika(object):
@@ -22,6 +28,24 @@ class PPrika(object):
         self.blueprints = {}  # {bp_name: blueprint}
         self.error_handlers = {}  # {bp_name: {status: {error: function}}}
         self.api_set = set()  # {bp_name, bp_name, ...}
+        self.max_content_length = None  # 请求体长度上限，可被路由的同名参数覆盖
+        self.max_content_lengths = {}  # {endpoint: max_content_length}
+        self.request_timeout = None  # 全局请求时限(秒)，从请求进入队列时算起(X-Request-Start)
+        self.timeouts = {}  # {endpoint: timeout}
+        self.head_handlers = {}  # {endpoint: 只返回headers的HEAD处理函数}
+        self.head_ttls = {}  # {endpoint: 缓存GET响应headers供HEAD直接使用的秒数}
+        self._head_cache = None  # pprika.cache.SimpleCache，{full_path: (status, headers)}
+        self.cors = None  # pprika.cors.Cors，为None时不处理跨域
+        self.error_routers = {}  # {bp_name: Api.handle_error}，Api的错误不经过app的处理流程
+        self.endpoint_blueprints = {}  # {endpoint: bp_name}，freeze时生成
+        self._handler_cache = {}  # {(bp_name, exc_class): handler}，freeze后才缓存
+        self.profiler = None  # pprika.profiler.Profiler，为None时不做性能分析
+        self.logger = None  # pprika.logger.Logger，为None时不记录访问日志，错误直接输出到stderr
+        self.route_cache = None  # pprika.routing.RouteCache，设置后rule推迟到freeze时编译并缓存到磁盘
+        self.pool_size = 16  # gather所用线程池的大小
+        self._executor = None
+        self._frozen = False
+        self._freeze_lock = Lock()
 
     def wsgi_app(self, environ, start_response):
         """
@@ -29,26 +53,156 @@ class PPrika(object):
         WSGI app，接受 __call__ / 前方server 调用，处理所有请求的入口
         匹配、处理请求并返回响应结果，捕捉、处理异常
         """
+        if not self._frozen:
+            self.freeze()  # 首个请求到来时自动冻结
+        if self.logger is not None:
+            start_response = self._logging_start_response(start_response)
+        if self.cors is not None and 'HTTP_ORIGIN' in environ:
+            start_response = self._cors_start_response(environ, start_response)
         ctx = RequestContext(self, environ)  # 请求上下文对象
         try:
             try:
                 ctx.bind()  # 绑定请求上下文并匹配路由
-                rv = self.dispatch_request()
-                response = make_response(rv)
+                method = environ['REQUEST_METHOD']
+                response = None
+                if method == 'OPTIONS':
+                    response = self.options_response()
+                elif method == 'HEAD' and self.head_ttls:
+                    response = self.cached_head_response()
+
+                if response is None:
+                    if self.profiler is None:
+                        rv = self.dispatch_request()
+                    else:
+                        rv = self.profiler.dispatch(self)
+                    response = fast_response(rv) or make_response(rv)
+                    if self.head_ttls and method == 'GET':  # HEAD响应(如来自head处理函数)没有真实的响应体
+                        response = self._remember_head(response)
             except Exception as e:
                 response = self.handle_exception(e)
             return response(environ, start_response)
         finally:
             ctx.unbind()
 
+    def _logging_start_response(self, start_response):
+        """包装start_response，在响应开始时记录状态码与耗时(不含响应体的发送)"""
+        started = perf_counter()
+
+        def logging_start_response(status, headers, exc_info=None):
+            self.logger.access(int(status[:3]), perf_counter() - started)
+            return start_response(status, headers, exc_info)
+        return logging_start_response
+
+    def _cors_start_response(self, environ, start_response):
+        """为跨域请求的响应附加 Access-Control-* 头，来源不被允许时不做改动"""
+        extra = self.cors.response_headers(environ)
+        if not extra:
+            return start_response
+
+        def cors_start_response(status, headers, exc_info=None):
+            return start_response(status, headers + extra, exc_info)
+        return cors_start_response
+
+    def options_response(self):
+        """
+        OPTIONS请求不进入dispatch_request，直接以路由匹配得到的允许方法应答(含CORS预检)
+        路由上显式允许了OPTIONS的仍交由视图处理；路径不存在时返回None，照常以404处理
+        """
+        e = request.routing_exception
+        if not isinstance(e, MethodNotAllowed):
+            return None
+        methods = ', '.join(sorted({*e.valid_methods, 'OPTIONS'}))
+        headers = [('Allow', methods)]
+        if self.cors is not None:
+            headers.extend(self.cors.preflight_headers(request.environ, methods))
+        return RawResponse(b'', _status_line(204), headers)
+
+    def cached_head_response(self):
+        """设有head_ttl的endpoint，HEAD请求直接使用缓存的GET响应headers(含Content-Length与ETag)"""
+        if request.routing_exception is not None or request.rule.endpoint not in self.head_ttls:
+            return None
+        cached = self._head_cache.get(request.full_path)
+        if cached is None:
+            return None
+        status, headers = cached
+        return RawResponse(b'', status, headers)
+
+    def _remember_head(self, response):
+        """缓存GET的2xx响应的状态与headers，并为其补上由响应体计算的ETag"""
+        ttl = self.head_ttls.get(request.rule.endpoint) if request.rule else None
+        parts = response_parts(response) if ttl is not None else None
+        if parts is None or not parts[1].startswith('2'):
+            return response
+
+        body, status, headers = parts
+        names = {name.lower() for name, _ in headers}
+        if 'etag' not in names:
+            etag = f'"{sha1(body).hexdigest()}"'
+            headers = headers + [('ETag', etag)]
+            if type(response) is RawResponse:
+                response = RawResponse(response.body, status, headers)  # headers可能是共享的列表，不原地修改
+            else:
+                response.headers['ETag'] = etag
+        if 'content-length' not in names:
+            headers = headers + [('Content-Length', str(len(body)))]
+        self._head_cache.set(request.full_path, (status, headers), ttl)
+        return response
+
+    def log_exception(self, e):
+        """记录未处理的异常，设置了logger时交由其异步写出"""
+        if self.logger is not None:
+            self.logger.exception(e)
+        else:
+            print_exception(*exc_info())
+
     def __call__(self, environ, start_response):
         return self.wsgi_app(environ, start_response)
 
+    def freeze(self):
+        """
+        冻结应用：执行所有蓝图推迟的注册，并预先生成请求时要用到的各种查找表
+        此后不可再注册路由、蓝图与错误处理器，请求处理时只需读取普通dict
+        首个请求到来时会自动调用，重复调用无影响
+        """
+        with self._freeze_lock:
+            if self._frozen:
+                return
+
+            for blueprint in self.blueprints.values():
+                blueprint.register(self)  # 执行蓝图的 _deferred_funcs
+
+            if self.route_cache is not None:
+                self.route_cache.compile(self.url_map)
+            self.url_map.update()  # 预先排序、编译所有rule
+            self.api_set = frozenset(self.api_set)
+            self.endpoint_blueprints = {
+                rule.endpoint: rule.endpoint.rsplit(".", 1)[0]
+                for rule in self.url_map.iter_rules() if "." in rule.endpoint
+            }
+            self._frozen = True
+
+    @property
+    def executor(self):
+        """pprika.concurrency.gather 所用的线程池，由所有请求共享，首次使用时创建"""
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            with self._freeze_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(self.pool_size, thread_name_prefix='pprika-gather')
+        return self._executor
+
+    def _check_not_frozen(self):
+        if self._frozen:
+            raise AssertionError("应用已冻结(已开始处理请求)，不可再修改路由或错误处理器")
+
     def run(self, host='localhost', port=9000, **options):
         """
         以 werkzeug 提供的服务器启动该应用实例
         以run_simple的 use_reloader、use_debugger 实现灵活的debug
         """
+        from werkzeug.serving import run_simple  # 仅启动开发服务器时才需要
+
         options.setdefault("threaded", True)  # 线程隔离
         run_simple(host, port, self, **options)
 
@@ -57,7 +211,12 @@ class PPrika(object):
         类似于flask的同名函数 `add_url_rule`，但仅实现了最基本的功能
         将一个url rule注册到对应的endpoint上，并把endpoint关联到处理函数view_func上
         借助endpoint实现path与func多对一，其中path与endpoint多对一，endpoint与view_func一对一
+        max_content_length：该endpoint请求体的长度上限(字节)，超出时在读取请求体前就返回 413
+        timeout：该endpoint的处理时限(秒)，超时返回 504，见 'dispatch_request'
+        head：只返回headers的HEAD处理函数(以 'head_response' 返回)，代替view_func处理HEAD请求
+        head_ttl：缓存GET响应的headers(补上ETag)的秒数，期间HEAD请求不执行视图；仅用于不区分用户的公开资源
         """
+        self._check_not_frozen()
         if endpoint is None:
             assert view_func is not None, "无endpoint时view_func不可为空"
             endpoint = view_func.__name__
@@ -68,7 +227,26 @@ class PPrika(object):
             methods = (methods,)
         methods = set(item.upper() for item in methods)
 
-        rule = Rule(path, methods=methods, endpoint=endpoint, **options)
+        max_content_length = options.pop('max_content_length', None)
+        if max_content_length is not None:
+            self.max_content_lengths[endpoint] = max_content_length
+        timeout = options.pop('timeout', None)
+        if timeout is not None:
+            self.timeouts[endpoint] = timeout
+        head = options.pop('head', None)
+        if head is not None:
+            self.head_handlers[endpoint] = head
+        head_ttl = options.pop('head_ttl', None)
+        if head_ttl is not None:
+            if self._head_cache is None:
+                from .cache import SimpleCache
+
+                self._head_cache = SimpleCache()
+            self.head_ttls[endpoint] = head_ttl
+
+        rule = CachedRule(path, methods=methods, endpoint=endpoint, **options)
+        if self.route_cache is not None:
+            self.route_cache.defer(rule)
         self.url_map.add(rule)
 
         # 为已有func的endpoint不带func地绑定新path - 单func多@route?
@@ -93,23 +271,51 @@ class PPrika(object):
         """
         接受 'wsgi_app'的调用，通过请求上下文得到对应endpoint与函数参数args
         再以endpoint作为键值得到处理该url的视图函数，传入args，返回函数结果
+
+        设有时限(request.deadline)时：开始处理前已超时(如排队过久)返回 503；
+        同步视图无法被中断，可在其中调用 request.check_deadline() 提前结束，异步视图(async def)则会在超时时被取消
+        GET/HEAD 处理结束后才发现超时的也返回 504；其他方法的结果可能已产生副作用(已写入、已推送)，
+        此时丢弃结果会使客户端重试而重复执行，因此照常返回
         """
         if request.routing_exception is not None:
             return self.handle_user_exception(request.routing_exception)
         # 'url_adapter.match' 时可能产生的路由错误
 
         try:
+            if request.deadline is not None and request.remaining() <= 0:
+                raise ServiceUnavailable('请求在开始处理前已超时')
+
             endpoint, args = request.rule.endpoint, request.view_args
-            rv = self.view_functions[endpoint](**args)
+            view = self.view_functions[endpoint]
+            if request.method == 'HEAD':
+                view = self.head_handlers.get(endpoint, view)
+            rv = view(**args)
+            if iscoroutine(rv):
+                rv = self.run_coroutine(rv)
+
+            if request.method in ('GET', 'HEAD'):
+                request.check_deadline()
         except Exception as e:
             rv = self.handle_user_exception(e)
         return rv
 
+    @staticmethod
+    def run_coroutine(coro):
+        """在当前线程运行异步视图返回的协程，超过 request.deadline 时取消并返回 504"""
+        import asyncio  # 仅有异步视图时才导入
+
+        timeout = request.remaining()
+        try:
+            return asyncio.run(asyncio.wait_for(coro, timeout))
+        except asyncio.TimeoutError:
+            raise GatewayTimeout()
+
     def register_blueprint(self, blueprint):
         """
-        接收blueprint实例，通过其register方法实现注册
+        接收blueprint实例，待freeze时再通过其register方法实现注册
         需保证注册的blueprint名都唯一
         """
+        self._check_not_frozen()
         bp_name = blueprint.name
         if bp_name in self.blueprints:
             assert blueprint is self.blueprints[bp_name], f"""
@@ -118,7 +324,6 @@ class PPrika(object):
             """
         else:
             self.blueprints[bp_name] = blueprint
-        blueprint.register(self)
 
     @staticmethod
     def _get_exc_class_and_code(exc_class_or_code):
@@ -150,20 +355,33 @@ class PPrika(object):
         1.蓝图 with code，2.全局 with code
         3.蓝图 without code，4.全局 without code
         若没有匹配的处理函数则返回None
+        冻结后错误处理器不再变化，查找结果按 (蓝图, 异常类) 缓存
         """
         exc_class, code = self._get_exc_class_and_code(type(e))
+        key = (request.blueprint, exc_class)
 
+        try:
+            return self._handler_cache[key]
+        except KeyError:
+            pass
+
+        handler = self._lookup_error_handler(request.blueprint, exc_class, code)
+        if self._frozen:
+            self._handler_cache[key] = handler
+        return handler
+
+    def _lookup_error_handler(self, blueprint, exc_class, code):
         for field, c in (
-                (request.blueprint, code),
+                (blueprint, code),
                 (None, code),
-                (request.blueprint, None),
+                (blueprint, None),
                 (None, None),
         ):
-            if request.blueprint in self.api_set and not field:
+            if blueprint in self.api_set and not field:
                 continue
             # .restful.Api 仅使用自身设置的错误处理器
 
-            handler_map = self.error_handlers.setdefault(field, {}).get(c)
+            handler_map = self.error_handlers.get(field, {}).get(c)
 
             if not handler_map:
                 continue
@@ -179,6 +397,7 @@ class PPrika(object):
         func被调用时接受该异常实例作为参数
         其中field为None时作用于全局(app)；为str时是蓝图名，仅作用于该蓝图(blueprint)
         """
+        self._check_not_frozen()
         if isinstance(code_or_exception, Exception):
             raise ValueError(f"""
                 不可注册异常实例: {repr(code_or_exception)}，
@@ -213,9 +432,18 @@ class PPrika(object):
         """
         处理无对应处理函数或处理函数中再次发生的异常
         非HTTPException将统一返回 500 ``InternalServerError`` 响应
+        Api外抛出的ApiException(如限流)则以其自身的响应格式返回
+        来自Api的错误则按蓝图名查表，直接交由该Api的handle_error处理
+        404/405类路由错误 request.__load__ 还未执行，blueprint为None，不被认为是Api内的错误
         """
+        router = self.error_routers.get(request.blueprint)
+        if router is not None:
+            return router(e)
+
         if isinstance(e, HTTPException):
             return e
+        if isinstance(e, ApiException):
+            return e.to_response()
 
         server_error = InternalServerError()
         server_error.original_exception = e
@@ -224,6 +452,6 @@ class PPrika(object):
         if handler is not None:
             server_error = handler(server_error)
         else:
-            print_exception(*exc_info())
+            self.log_exception(e)
 
         return make_response(server_error)
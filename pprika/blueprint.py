@@ -11,6 +11,7 @@ class Blueprint(object):
         self.name = name
         self.url_prefix = url_prefix
         self._deferred_funcs = []
+        self._registered = False  # 已被app冻结时注册，之后不可再修改
 
     def register(self, app):
         """
@@ -19,6 +20,13 @@ class Blueprint(object):
         """
         for f in self._deferred_funcs:  # 注册一些需要app的函数
             f(app)  # 要实现注册时更改url_prefix得加一层BlueprintState
+        self._registered = True
+
+    def _defer(self, func):
+        """推迟到注册时执行func(app)；已注册(app已冻结)后推迟的函数不会再执行，因此直接报错"""
+        if self._registered:
+            raise AssertionError("应用已冻结(已开始处理请求)，不可再修改路由或错误处理器")
+        self._deferred_funcs.append(func)
 
     def add_url_rule(self, path, endpoint=None, view_func=None, **options):
         """
@@ -40,7 +48,7 @@ class Blueprint(object):
         endpoint = f'{self.name}.{endpoint}'
 
         # 函数通过deferred_funcs转发，等到有了app再执行(注册rule)
-        self._deferred_funcs.append(
+        self._defer(
             lambda a: a.add_url_rule(path, endpoint, view_func, **options)
         )
 
@@ -58,7 +66,7 @@ class Blueprint(object):
         """
         注册错误处理器，仅作用于当前blueprint的请求
         """
-        self._deferred_funcs.append(
+        self._defer(
             lambda a: a.register_error_handler(code_or_exception, func, self.name)
         )
 
@@ -67,7 +75,7 @@ class Blueprint(object):
         register_error_handler的装饰器版本
         """
         def wrapper(func):
-            self._deferred_funcs.append(
+            self._defer(
                 lambda a: a.register_error_handler(code_or_exception, func, self.name)
             )
             return func
@@ -78,7 +86,7 @@ class Blueprint(object):
         注册错误处理器，作用于所有请求
         """
         def wrapper(func):
-            self._deferred_funcs.append(
+            self._defer(
                 lambda a: a.error_handler(code_or_exception)(func)
             )
             return func
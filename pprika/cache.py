@@ -0,0 +1,249 @@
+from .context import request
+from .helpers import RawResponse, finalize_response, response_parts
+from multiprocessing import Lock as ProcessLock
+from multiprocessing.shared_memory import SharedMemory
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from hashlib import blake2b
+from marshal import dumps as marshal_dumps, loads as marshal_loads
+from time import time
+import atexit
+import struct
+import os
+
+
+class SimpleCache(object):
+    """进程内的缓存，超出max_keys时淘汰最久未使用的"""
+
+    def __init__(self, max_keys=1024):
+        self.max_keys = max_keys
+        self._store = OrderedDict()  # {key: (expires, value)}
+        self._lock = Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._store.get(key)
+            if item is None:
+                return None
+            if item[0] <= time():
+                del self._store[key]
+                return None
+            self._store.move_to_end(key)
+            return item[1]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._store[key] = (time() + ttl, value)
+            self._store.move_to_end(key)
+            if len(self._store) > self.max_keys:
+                self._store.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            return self._store.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._store.clear()
+
+
+class SharedMemoryCache(object):
+    """
+    基于 multiprocessing.shared_memory 的跨进程缓存，预fork的多个worker共享同一份缓存
+    须在fork之前(如 gunicorn 的 preload_app 下于模块加载时)创建，worker继承共享内存与锁
+
+    共享内存为定长的组相联哈希表：slots个槽，每ways个槽为一组，key按哈希落入一组
+    组内无空槽时淘汰最久未访问的槽(组内LRU)；每组由 stripes 把进程锁之一保护
+    值只接受bytes，不经pickle；大于 slot_size 减去槽头与key长度的值不缓存
+
+    槽的布局：| 哈希 Q | 过期时间 d | 访问时间 d | key长 H | 值长 I | 占用 B | pad | key | value |
+    """
+
+    _header = struct.Struct('<QddHIBx')
+    _flag = 30  # 占用标志在槽头中的偏移
+    _EMPTY, _USED = 0, 1
+
+    def __init__(self, slots=4096, slot_size=16 * 1024, ways=8, stripes=64, name=None):
+        assert slots % ways == 0, 'slots须为ways的整数倍'
+        assert slot_size > self._header.size, 'slot_size过小'
+        self.slots = slots
+        self.slot_size = slot_size
+        self.ways = ways
+        self.sets = slots // ways
+        self.shm = SharedMemory(name=name, create=True, size=slots * slot_size)  # 新建的共享内存已清零
+        self.buf = self.shm.buf
+        self._locks = [ProcessLock() for _ in range(min(stripes, self.sets))]
+        self._owner = os.getpid()
+        atexit.register(self.close)
+
+    @staticmethod
+    def _hash(key):
+        return int.from_bytes(blake2b(key, digest_size=8).digest(), 'little')  # 各进程的 hash() 不一致
+
+    def _locate(self, key):
+        """返回 (key bytes, 哈希, 组的首个槽号, 组的锁)"""
+        if isinstance(key, str):
+            key = key.encode()
+        h = self._hash(key)
+        group = h % self.sets
+        return key, h, group * self.ways, self._locks[group % len(self._locks)]
+
+    def _find(self, key, h, first):
+        """在组内查找key，返回 (槽偏移, 槽头) 或 None，须持有锁"""
+        buf, header, size = self.buf, self._header, self._header.size
+        for offset in range(first * self.slot_size, (first + self.ways) * self.slot_size, self.slot_size):
+            fields = header.unpack_from(buf, offset)
+            if (fields[5] == self._USED and fields[0] == h and fields[3] == len(key)
+                    and buf[offset + size:offset + size + len(key)] == key):
+                return offset, fields
+        return None
+
+    def get(self, key):
+        """返回缓存的bytes，在锁内复制一次，不存在或已过期返回None"""
+        key, h, first, lock = self._locate(key)
+        with lock:
+            found = self._find(key, h, first)
+            if found is None:
+                return None
+            offset, (_, expires, _, klen, vlen, _) = found
+            now = time()
+            if expires <= now:
+                self.buf[offset + self._flag] = self._EMPTY
+                return None
+            struct.pack_into('<d', self.buf, offset + 16, now)
+            start = offset + self._header.size + klen
+            return bytes(self.buf[start:start + vlen])
+
+    def set(self, key, value, ttl):
+        """写入bytes，值过大无法放入槽时返回False"""
+        key, h, first, lock = self._locate(key)
+        value = memoryview(value).cast('B')
+        size = self._header.size
+        if size + len(key) + len(value) > self.slot_size:
+            return False
+
+        with lock:
+            found = self._find(key, h, first)
+            if found is not None:
+                offset = found[0]
+            else:
+                offset = self._victim(first)
+            now = time()
+            self.buf[offset + self._flag] = self._EMPTY  # 写入期间先标记为空
+            start = offset + size
+            self.buf[start:start + len(key)] = key
+            self.buf[start + len(key):start + len(key) + len(value)] = value
+            self._header.pack_into(self.buf, offset, h, now + ttl, now, len(key), len(value), self._USED)
+        return True
+
+    def _victim(self, first):
+        """选出组内可写入的槽：空槽、过期槽，否则最久未访问的槽"""
+        now = time()
+        victim, oldest = None, None
+        for offset in range(first * self.slot_size, (first + self.ways) * self.slot_size, self.slot_size):
+            _, expires, atime, _, _, used = self._header.unpack_from(self.buf, offset)
+            if used != self._USED or expires <= now:
+                return offset
+            if oldest is None or atime < oldest:
+                victim, oldest = offset, atime
+        return victim
+
+    def delete(self, key):
+        key, h, first, lock = self._locate(key)
+        with lock:
+            found = self._find(key, h, first)
+            if found is None:
+                return False
+            self.buf[found[0] + self._flag] = self._EMPTY
+            return True
+
+    def clear(self):
+        for lock in self._locks:
+            lock.acquire()
+        try:
+            for offset in range(0, self.slots * self.slot_size, self.slot_size):
+                self.buf[offset + self._flag] = self._EMPTY
+        finally:
+            for lock in self._locks:
+                lock.release()
+
+    def close(self):
+        """释放映射，创建者进程同时删除共享内存"""
+        if self.shm is None:
+            return
+        self.buf.release()
+        self.shm.close()
+        if os.getpid() == self._owner:
+            self.shm.unlink()
+        self.shm = self.buf = None
+
+
+class Cache(object):
+    """
+    视图响应缓存，默认使用进程内的SimpleCache，多worker部署时可换为SharedMemoryCache
+
+    用法：
+    cache = Cache(SharedMemoryCache())
+    @cache.cached(ttl=30) 装饰视图函数/Resource的方法，仅缓存GET请求的非5xx、非流式响应，HEAD请求可由其缓存应答
+    数据变化时 cache.delete(key) 或 cache.clear()，视图的缓存键为 "endpoint:key_func()"
+
+    key_func：生成缓存键，默认为请求的路径与查询串；响应随用户不同时应把用户身份加入键中
+    """
+
+    def __init__(self, backend=None):
+        self.backend = backend if backend is not None else SimpleCache()
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, value, ttl):
+        return self.backend.set(key, value, ttl)
+
+    def delete(self, key):
+        return self.backend.delete(key)
+
+    def clear(self):
+        self.backend.clear()
+
+    @staticmethod
+    def default_key():
+        return request.full_path
+
+    @staticmethod
+    def dumps(body, status, headers):
+        """响应编码为bytes：| 元数据长度 I | marshal(status, headers) | body |"""
+        meta = marshal_dumps((status, [tuple(h) for h in headers]))
+        return len(meta).to_bytes(4, 'little') + meta + body
+
+    @staticmethod
+    def loads(data):
+        n = int.from_bytes(data[:4], 'little')
+        status, headers = marshal_loads(memoryview(data)[4:4 + n])
+        return data[4 + n:], status, headers
+
+    def cached(self, ttl=60, key_func=None):
+        key_func = key_func or self.default_key
+
+        def decorator(func):
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if request.method not in ('GET', 'HEAD'):
+                    return func(*args, **kwargs)
+
+                key = f'{request.rule.endpoint}:{key_func()}'
+                data = self.backend.get(key)
+                if data is not None:
+                    body, status, headers = self.loads(data)
+                    return RawResponse(body, status, headers)
+
+                response = finalize_response(func(*args, **kwargs))
+                if request.method != 'GET':
+                    return response  # HEAD的响应(如 'head_response')不含响应体，不可用于应答GET
+                parts = response_parts(response)
+                if parts is not None and not parts[1].startswith('5'):
+                    self.backend.set(key, self.dumps(*parts), ttl)
+                return response
+            return wrapper
+        return decorator
@@ -0,0 +1,92 @@
+from .context import request, current_app, _req_ctx_ls
+from werkzeug.exceptions import GatewayTimeout
+from concurrent.futures import wait, FIRST_EXCEPTION, ALL_COMPLETED
+from inspect import isawaitable
+from threading import local
+import sys
+
+_worker = local()  # 标记当前线程正在线程池中执行gather的调用
+
+
+def _in_context(ctx, func):
+    """在线程池的线程中绑定发起者的请求上下文后执行func，request、current_app与deadline都与视图中一致"""
+    _req_ctx_ls.ctx = ctx
+    _worker.active = True
+    try:
+        return func()
+    finally:
+        _worker.active = False
+        _req_ctx_ls.__release_local__()
+
+
+def _run_inline(calls, return_exceptions):
+    results = []
+    for func in calls:
+        try:
+            results.append(func())
+        except Exception as e:
+            if not return_exceptions:
+                raise
+            results.append(e)
+    return results
+
+
+async def _gather_async(calls, return_exceptions):
+    import asyncio
+
+    loop = asyncio.get_running_loop()
+    ctx = _req_ctx_ls.ctx
+    aws = [
+        call if isawaitable(call) else loop.run_in_executor(current_app.executor, _in_context, ctx, call)
+        for call in calls
+    ]
+    return await asyncio.gather(*aws, return_exceptions=return_exceptions)
+
+
+def _loop_running():
+    if 'asyncio' not in sys.modules:  # 未导入asyncio时不可能有运行中的事件循环
+        return False
+    import asyncio
+
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return False
+    return True
+
+
+def gather(*calls, return_exceptions=False):
+    """
+    并发执行多个互不依赖的调用(如查询多个后端)，按传入顺序返回结果列表，总耗时约为其中最慢的一个
+
+    同步视图中：calls为无参可调用对象，如 gather(lambda: get_user(uid), partial(get_voices, uid))
+    在 app.executor(大小为 app.pool_size 的线程池)中执行，各调用中可照常使用request与current_app
+    等待不超过 request.deadline，超时返回 504；任一调用出错时取消尚未开始的调用并抛出该错误，
+    return_exceptions为True时则将错误作为结果返回；已开始的调用无法中断
+
+    异步视图中(当前线程有运行中的事件循环)：await gather(coro1, coro2, sync_callable)，对应 asyncio.gather，
+    其中的同步可调用对象同样交由 app.executor 执行；此时gather总是返回可await的对象，即使calls全为同步可调用对象
+
+    请求体应在调用gather之前读取，各调用并发读取请求体是不安全的
+    """
+    if _loop_running():
+        return _gather_async(calls, return_exceptions)
+    if len(calls) <= 1 or getattr(_worker, 'active', False):
+        return _run_inline(calls, return_exceptions)  # 嵌套的gather直接依次执行，避免等待自身所在的线程池而死锁
+
+    ctx = _req_ctx_ls.ctx
+    futures = [current_app.executor.submit(_in_context, ctx, call) for call in calls]
+    done, pending = wait(futures, request.remaining(), ALL_COMPLETED if return_exceptions else FIRST_EXCEPTION)
+
+    if not return_exceptions:
+        for future in futures:
+            if future in done and future.exception() is not None:
+                for other in pending:
+                    other.cancel()
+                raise future.exception()
+    if pending:
+        for future in pending:
+            future.cancel()
+        raise GatewayTimeout()
+
+    return [future.exception() or future.result() for future in futures]
@@ -1,7 +1,15 @@
 from werkzeug.local import LocalProxy, Local
 from werkzeug.wrappers import Request as BaseRequest
-from werkzeug.exceptions import HTTPException
+from werkzeug.exceptions import HTTPException, RequestEntityTooLarge, GatewayTimeout, BadRequest, UnsupportedMediaType
+from werkzeug.http import parse_options_header
+from werkzeug.utils import cached_property
+from werkzeug.wsgi import get_input_stream
+from time import time
+from tempfile import SpooledTemporaryFile
+from io import BytesIO
 from json import loads
+from math import isfinite
+import zlib
 
 
 def _get_req_object():
@@ -12,37 +20,214 @@ def _get_req_object():
         raise RuntimeError('脱离请求上下文!')
 
 
+def _get_app_object():
+    try:
+        return _req_ctx_ls.ctx.app
+    except AttributeError:
+        raise RuntimeError('脱离请求上下文!')
+
+
 _req_ctx_ls = Local()  # request_context_localStorage, 只考虑一般情况:一个请求一个ctx
 request = LocalProxy(_get_req_object)
+current_app = LocalProxy(_get_app_object)  # 处理当前请求的app
+
+
+class _DecodingStream(object):
+    """
+    边读边解压请求体，每次解压的输出不超过所需的长度
+    分别限制读入的压缩数据(max_raw)与解压后的数据(max_decoded)大小，超出时抛出 413
+    """
+
+    chunk_size = 64 * 1024
+
+    def __init__(self, stream, wbits, max_raw, max_decoded):
+        self.stream = stream
+        self.wbits = wbits
+        self.max_raw = max_raw
+        self.max_decoded = max_decoded
+        self.raw_read = 0
+        self.decoded = 0
+        self._obj = zlib.decompressobj(wbits)
+        self._buf = b''
+        self._eof = False
+
+    def _decompress(self, data, want):
+        try:
+            return self._obj.decompress(data, want)
+        except zlib.error:
+            if self.decoded or self.wbits != zlib.MAX_WBITS:
+                raise BadRequest('请求体解压失败')
+            # 部分客户端的deflate不带zlib头，改为按原始deflate解压
+            self.wbits = -zlib.MAX_WBITS
+            self._obj = zlib.decompressobj(self.wbits)
+            return self._decompress(data, want)
+
+    def _next(self, want):
+        """解压出不超过want字节的下一段数据，结束时返回b''"""
+        obj = self._obj
+        while not self._eof:
+            if obj.unconsumed_tail:
+                data = self._decompress(obj.unconsumed_tail, want)
+            elif obj.eof:
+                self._eof = True
+                break
+            else:
+                raw = self.stream.read(self.chunk_size)
+                if not raw:
+                    self._eof = True
+                    if not obj.eof:
+                        raise BadRequest('压缩的请求体不完整')
+                    break
+                self.raw_read += len(raw)
+                if self.max_raw is not None and self.raw_read > self.max_raw:
+                    raise RequestEntityTooLarge()
+                data = self._decompress(raw, want)
+                obj = self._obj
+
+            if data:
+                self.decoded += len(data)
+                if self.max_decoded is not None and self.decoded > self.max_decoded:
+                    raise RequestEntityTooLarge('解压后的请求体过大')
+                return data
+        return b''
+
+    def read(self, size=-1):
+        chunks, have = [self._buf], len(self._buf)
+        while size is None or size < 0 or have < size:
+            data = self._next(self.chunk_size if size is None or size < 0 else size - have)
+            if not data:
+                break
+            chunks.append(data)
+            have += len(data)
+
+        data = b''.join(chunks)
+        if size is not None and 0 <= size < len(data):
+            data, self._buf = data[:size], data[size:]
+        else:
+            self._buf = b''
+        return data
+
+    def exhaust(self):
+        while self.read(self.chunk_size):
+            pass
 
 
 class Request(BaseRequest):
+    spool_threshold = 500 * 1024  # 上传文件超过该大小时由内存转存到临时文件
+    max_decoded_length = 16 * 1024 * 1024  # 压缩的请求体解压后的大小上限，压缩前的大小由max_content_length限制
+    content_codings = {  # 支持的 Content-Encoding 及对应的zlib wbits
+        'gzip': 16 + zlib.MAX_WBITS,
+        'x-gzip': 16 + zlib.MAX_WBITS,
+        'deflate': zlib.MAX_WBITS,
+    }
+
     def __init__(self, environ):
         self.rule = None  # werkzeug.routing.Rule对象
         self.view_args = None  # 将传给视图函数的参数
         self.blueprint = None  # 该请求所在蓝图名，为None表示在app上
         self.routing_exception = None  # 暂存路由错误
+        self.deadline = None  # 请求处理的截止时间戳，为None表示不限时
+        self.discard_files = False  # 为True时解析表单丢弃上传文件的内容，见 'discard_uploads'
         super().__init__(environ)
 
-    def __load__(self, res):
+    def __load__(self, res, endpoint_blueprints):
         """
         为request绑上blueprint、rule与函数参数，可调用rule.endpoint、rule.methods(集合来着?)
         不过request已有method属性
+        endpoint_blueprints为app冻结时生成的 {endpoint: bp_name} 表
         """
         self.rule, self.view_args = res
 
-        if self.rule and "." in self.rule.endpoint:
-            self.blueprint = self.rule.endpoint.rsplit(".", 1)[0]
+        if self.rule:
+            self.blueprint = endpoint_blueprints.get(self.rule.endpoint)
+
+    @cached_property
+    def stream(self):
+        """
+        带 Content-Encoding: gzip/deflate 的请求体在此透明地解压，
+        get_data、json、form 及 RequestParser 读到的都是解压后的数据，且只解压一次(由get_data缓存)
+        """
+        stream = get_input_stream(self.environ)
+        coding = self.content_encoding
+        if not coding or coding.strip().lower() == 'identity':
+            return stream
+
+        wbits = self.content_codings.get(coding.strip().lower())
+        if wbits is None:
+            raise UnsupportedMediaType(f'不支持的 Content-Encoding: {coding}')
+        return _DecodingStream(stream, wbits, self.max_content_length, self.max_decoded_length)
+
+    def _load_form_data(self):
+        """压缩的请求体解压后长度未知，不能以 Content-Length 限制表单解析的读取长度"""
+        if not self.content_encoding or 'form' in self.__dict__:
+            return super()._load_form_data()
+
+        mimetype, options = parse_options_header(self.environ.get('CONTENT_TYPE', ''))
+        parser = self.make_form_data_parser()
+        d = self.__dict__
+        d['stream'], d['form'], d['files'] = parser.parse(self._get_stream_for_parsing(), mimetype, None, options)
 
     @property
     def json(self):
-        """从data解析json，若无数据则返回None"""
-        if self.data and self.mimetype == 'application/json':
+        """从data解析json，若无数据则返回None；先判断mimetype，避免访问data时解析表单"""
+        if self.mimetype == 'application/json' and self.data:
             return loads(self.data)
 
+    def remaining(self):
+        """距离截止时间剩余的秒数，可作为调用下游服务的超时时间；不限时返回None"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time(), 0.0)
+
+    def check_deadline(self):
+        """已超过截止时间时抛出 504 GatewayTimeout，供耗时的视图函数在各步骤之间调用"""
+        if self.deadline is not None and time() >= self.deadline:
+            raise GatewayTimeout()
+
+    def discard_uploads(self):
+        """
+        表单尚未解析时，使之后的解析丢弃上传文件的内容(files中仍有对应的键，但文件为空)，
+        供不需要文件的视图避免写入内存或临时文件；表单已解析时无效
+        """
+        if 'form' not in self.__dict__:
+            self.discard_files = True
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        """上传的文件边解析边写入 SpooledTemporaryFile，小文件留在内存，大文件转存磁盘"""
+        if self.discard_files:
+            return _DiscardedFile()
+        return SpooledTemporaryFile(max_size=self.spool_threshold, mode='wb+')
+
+
+class _DiscardedFile(BytesIO):
+    """丢弃写入内容的文件对象"""
+
+    def write(self, b):
+        return len(b)
+
+
+def _parse_request_start(value):
+    """解析代理设置的 X-Request-Start('t=1600000000.123'，单位可为秒/毫秒/微秒)"""
+    try:
+        start = float(value[2:] if value.startswith('t=') else value)
+    except ValueError:
+        return None
+    if not isfinite(start) or start <= 0:
+        return None
+    if start > 1e14:
+        return start / 1e6
+    if start > 1e11:
+        return start / 1e3
+    return start
+
 
 class RequestContext(object):
+    deadline_header = 'X-Request-Timeout'  # 客户端传递的剩余时限(秒)
+    max_client_timeout = 300  # 客户端时限的上限(秒)
+
     def __init__(self, app, environ):
+        self.started = time()
+        self.app = app
         self.url_adapter = app.url_map.bind_to_environ(environ)
         self.request = Request(environ)  # 即全局变量request
 
@@ -59,7 +244,47 @@ class RequestContext(object):
         """进行路由的匹配，得到url_rule与视图函数的调用参数"""
         try:
             res = self.url_adapter.match(return_rule=True)
-            self.request.__load__(res)
+            self.request.__load__(res, self.app.endpoint_blueprints)
+            self.check_content_length()
+            self.set_deadline()
         except HTTPException as e:
             self.request.routing_exception = e
             # 暂存错误，之后于handle_user_exception尝试处理
+
+    def set_deadline(self):
+        """
+        取以下时限中最早的作为 request.deadline：
+        app.request_timeout(从 X-Request-Start 算起，包括排队时间)、路由的timeout、客户端请求头给出的时限
+        客户端时限只接受有限的正数，超过 max_client_timeout 的按其截断，无效的值被忽略
+        """
+        req, app = self.request, self.app
+        deadlines = []
+
+        if app.request_timeout is not None:
+            queued = req.headers.get('X-Request-Start')
+            start = queued and _parse_request_start(queued) or self.started
+            deadlines.append(min(start, self.started) + app.request_timeout)
+
+        timeout = app.timeouts.get(req.rule.endpoint)
+        if timeout is not None:
+            deadlines.append(self.started + timeout)
+
+        client_timeout = req.headers.get(self.deadline_header, type=float)
+        if client_timeout is not None and isfinite(client_timeout) and client_timeout > 0:
+            deadlines.append(self.started + min(client_timeout, self.max_client_timeout))
+
+        if deadlines:
+            req.deadline = min(deadlines)
+
+    def check_content_length(self):
+        """
+        按路由(或app)设置的 max_content_length 在读取请求体之前检查其长度
+        未声明长度的请求(如chunked)则由werkzeug解析表单时限制
+        """
+        req = self.request
+        limit = self.app.max_content_lengths.get(req.rule.endpoint, self.app.max_content_length)
+        if limit is None:
+            return
+        req.max_content_length = limit
+        if req.content_length is not None and req.content_length > limit:
+            raise RequestEntityTooLarge()
@@ -0,0 +1,61 @@
+class Cors(object):
+    """
+    跨域资源共享(CORS)配置，OPTIONS预检请求由 'app.wsgi_app' 按路由表直接应答，不进入dispatch_request
+
+    用法：Cors(app, origins=['https://example.com'], allow_headers=['Content-Type', 'AuthToken'])
+
+    origins：允许的来源，'*' 表示任意来源
+    allow_headers：预检时允许的请求头，为None时照搬请求的 Access-Control-Request-Headers
+    expose_headers：允许浏览器中的脚本读取的响应头
+    max_age：预检结果的缓存时间(秒)
+    credentials：是否允许携带cookie等凭据，为True时不会返回 '*' 而是返回请求的来源
+    """
+
+    def __init__(self, app, origins='*', allow_headers=None, expose_headers=(), max_age=600, credentials=False):
+        self.origins = '*' if origins == '*' else frozenset(origins)
+        self.allow_headers = None if allow_headers is None else ', '.join(allow_headers)
+        self.expose_headers = ', '.join(expose_headers)
+        self.max_age = str(max_age)
+        self.credentials = credentials
+        app.cors = self
+
+    def allow_origin(self, origin):
+        """返回 Access-Control-Allow-Origin 的值，不允许该来源时返回None"""
+        if not origin:
+            return None
+        if self.origins == '*':
+            return origin if self.credentials else '*'
+        return origin if origin in self.origins else None
+
+    def _common_headers(self, allowed):
+        headers = [('Access-Control-Allow-Origin', allowed)]
+        if allowed != '*':
+            headers.append(('Vary', 'Origin'))
+        if self.credentials:
+            headers.append(('Access-Control-Allow-Credentials', 'true'))
+        return headers
+
+    def preflight_headers(self, environ, methods):
+        """预检请求特有的响应头，methods为该路径允许的方法；Allow-Origin等由 'response_headers' 给出"""
+        allowed = self.allow_origin(environ.get('HTTP_ORIGIN'))
+        if allowed is None or 'HTTP_ACCESS_CONTROL_REQUEST_METHOD' not in environ:
+            return []
+
+        headers = [('Access-Control-Allow-Methods', methods)]
+        request_headers = self.allow_headers
+        if request_headers is None:
+            request_headers = environ.get('HTTP_ACCESS_CONTROL_REQUEST_HEADERS')
+        if request_headers:
+            headers.append(('Access-Control-Allow-Headers', request_headers))
+        headers.append(('Access-Control-Max-Age', self.max_age))
+        return headers
+
+    def response_headers(self, environ):
+        """跨域请求(含预检)的响应都需附加的头"""
+        allowed = self.allow_origin(environ.get('HTTP_ORIGIN'))
+        if allowed is None:
+            return []
+        headers = self._common_headers(allowed)
+        if self.expose_headers:
+            headers.append(('Access-Control-Expose-Headers', self.expose_headers))
+        return headers
@@ -1,22 +1,98 @@
+from .context import request, current_app
 from json import dumps
-from functools import partial
+from functools import partial, wraps
 from werkzeug.wrappers import Response, BaseResponse
 from werkzeug.datastructures import Headers
 from werkzeug.exceptions import HTTPException
+from werkzeug.http import HTTP_STATUS_CODES, http_date, parse_date, parse_range_header
+from werkzeug.urls import url_quote
+from mimetypes import guess_type
+from mmap import mmap, ACCESS_READ
+from time import time
+from calendar import timegm
+import os
 
-json_config = {'ensure_ascii': False, 'indent': None, 'separators': (',', ':')}
+
+def _json_default(o):
+    """使 restful.Record 等带有to_dict方法的对象可直接序列化"""
+    to_dict = getattr(o, 'to_dict', None)
+    if to_dict is None:
+        raise TypeError(f'Object of type {type(o).__name__} is not JSON serializable')
+    return to_dict()
+
+
+json_config = {'ensure_ascii': False, 'indent': None, 'separators': (',', ':'), 'default': _json_default}
 compact_dumps = partial(dumps, **json_config)
 
+_status_lines = {}  # {200: '200 OK'}
+_fast_types = {  # 可走快速路径的响应体类型及其Content-Type
+    dict: 'application/json',
+    list: 'application/json',
+    bytes: 'text/plain; charset=utf-8',
+}
 
-def make_response(rv=None):
+
+class RawResponse(object):
     """
-    rv为视图函数返回值(body, status, headers)三元组、或响应实例
-    将返回Response对象实例
+    极简的WSGI响应，仅含状态行、header列表与单个bytes响应体
+    由 'fast_response' 生成，直接调用start_response，不经过werkzeug Response
     """
-    status = headers = None
+    __slots__ = ('status', 'headers', 'body')
 
-    if isinstance(rv, (BaseResponse, HTTPException)):
-        return rv
+    def __init__(self, body, status, headers):
+        self.body = body
+        self.status = status
+        self.headers = headers
+
+    def __call__(self, environ, start_response):
+        start_response(self.status, self.headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            return []
+        return [self.body]
+
+
+def _status_line(code):
+    line = _status_lines.get(code)
+    if line is None:
+        line = _status_lines[code] = f"{code} {HTTP_STATUS_CODES.get(code, 'UNKNOWN').upper()}"
+    return line
+
+
+def fast_response(rv):
+    """
+    视图函数返回值为 dict/list/bytes 或 (body, int status) 且无自定义headers时，
+    直接生成 RawResponse；其余情况返回None，交由 'make_response' 处理
+    """
+    status = 200
+    if type(rv) is tuple:
+        if len(rv) != 2 or type(rv[1]) is not int:
+            return None
+        rv, status = rv
+        if not 100 <= status <= 999:
+            return None
+
+    content_type = _fast_types.get(type(rv))
+    if content_type is None:
+        return None
+
+    body = rv if type(rv) is bytes else compact_dumps(rv).encode()
+    headers = [('Content-Type', content_type), ('Content-Length', str(len(body)))]
+    return RawResponse(body, _status_line(status), headers)
+
+
+def head_response(headers, status=200):
+    """
+    供HEAD处理函数返回只有headers的响应，其中的Content-Length等原样保留，不会按空响应体重新计算
+    如：return head_response({'Content-Length': str(size), 'ETag': etag})
+    """
+    if isinstance(headers, dict):
+        headers = list(headers.items())
+    return RawResponse(b'', _status_line(status), headers)
+
+
+def _unpack(rv):
+    """将视图函数返回值拆分为 (body, status, headers)"""
+    status = headers = None
 
     if isinstance(rv, tuple):
         len_rv = len(rv)
@@ -34,6 +110,21 @@ def make_response(rv=None):
                 '视图函数返回值若为tuple至少要有响应体body，'
                 '可选status与headers，如(body, status, headers)'
             )
+    return rv, status, headers
+
+
+def make_response(rv=None):
+    """
+    rv为视图函数返回值(body, status, headers)三元组、或响应实例
+    将返回Response对象实例
+    """
+    if isinstance(rv, (BaseResponse, HTTPException, RawResponse)):
+        return rv
+
+    rv, status, headers = _unpack(rv)
+
+    if hasattr(rv, 'to_dict'):
+        rv = rv.to_dict()
 
     if isinstance(rv, (dict, list)):
         rv = compact_dumps(rv)
@@ -46,3 +137,180 @@ def make_response(rv=None):
 
     response = Response(rv, status=status, headers=headers)
     return response
+
+
+class Envelope(object):
+    """
+    响应外壳，如 {'code': 0, 'msg': '', 'data': ...}，用于 Api(envelope=...)
+    fields为外壳中固定不变的部分，视图函数只需返回data部分(可带status、headers)
+
+    固定部分只在创建时序列化一次，拆成前缀与后缀bytes，
+    每次请求只序列化data并拼接在中间
+    """
+
+    def __init__(self, fields, key='data'):
+        assert key not in fields, f"fields中不应含有 {key}"
+        head = compact_dumps(fields)[:-1]  # 去掉末尾的 '}'
+        if fields:
+            head += ','
+        self.fields = fields
+        self.key = key
+        self.prefix = f'{head}{compact_dumps(key)}:'.encode()
+        self.suffix = b'}'
+
+    def encode(self, data):
+        return b''.join((self.prefix, compact_dumps(data).encode(), self.suffix))
+
+    def make_response(self, rv):
+        """响应实例直接返回，其余返回值的body部分套上外壳"""
+        if isinstance(rv, (BaseResponse, HTTPException, RawResponse)):
+            return rv
+
+        rv, status, headers = _unpack(rv)
+        body = self.encode(rv)
+
+        if headers is None and (status is None or type(status) is int):
+            headers = [('Content-Type', 'application/json'), ('Content-Length', str(len(body)))]
+            return RawResponse(body, _status_line(status or 200), headers)
+
+        headers = Headers(headers)
+        headers.setdefault('Content-Type', 'application/json')
+        return Response(body, status=status, headers=headers)
+
+    def __call__(self, func):
+        """作为装饰器，将视图函数的返回值套上外壳"""
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.make_response(func(*args, **kwargs))
+        return wrapper
+
+
+def finalize_response(rv):
+    """
+    在视图函数的装饰器中将返回值转化为最终响应，所在Api设有envelope时同样套上外壳
+    供需要保存响应内容的装饰器(如缓存、幂等)使用
+    """
+    envelope = getattr(current_app.blueprints.get(request.blueprint), 'envelope', None)
+    if envelope is not None:
+        return envelope.make_response(rv)
+    return fast_response(rv) or make_response(rv)
+
+
+def response_parts(response):
+    """取出响应的 (body, status, headers) 以便保存，流式响应返回None"""
+    if type(response) is RawResponse:
+        return response.body, response.status, response.headers
+    if isinstance(response, BaseResponse) and not response.is_streamed:
+        return response.get_data(), response.status, response.headers.to_wsgi_list()
+    return None
+
+
+class FileResponse(RawResponse):
+    """
+    由 'send_file' 生成的文件/大块数据响应，调用时才根据请求头决定返回全部或部分(Range)内容
+    完整的文件响应交给服务器提供的 wsgi.file_wrapper(通常以sendfile实现)，
+    否则以mmap分块读取，内存占用与文件大小无关
+    """
+    __slots__ = ('file', 'size', 'last_modified', 'blocksize')
+
+    def __init__(self, file, size, headers, last_modified, blocksize):
+        super().__init__(file if isinstance(file, (bytes, bytearray, memoryview)) else None, '200 OK', headers)
+        self.file = file
+        self.size = size
+        self.last_modified = last_modified
+        self.blocksize = blocksize
+
+    def _close(self):
+        if self.body is None:
+            self.file.close()
+
+    def _reply(self, code, start_response, headers=()):
+        self._close()
+        start_response(_status_line(code), self.headers + list(headers))
+        return []
+
+    def __call__(self, environ, start_response):
+        if self.last_modified is not None:
+            since = parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+            # parse_date返回不带时区的UTC时间，不可用timestamp()(会按本地时区解释)
+            if since is not None and int(self.last_modified) <= timegm(since.utctimetuple()):
+                return self._reply(304, start_response)
+
+        start, stop, code = 0, self.size, 200
+        headers = self.headers + [('Accept-Ranges', 'bytes')]
+
+        ranges = parse_range_header(environ.get('HTTP_RANGE'))
+        if_range = environ.get('HTTP_IF_RANGE')  # 文件在断点续传期间已修改时返回全部内容
+        if ranges is not None and (not if_range or parse_date(if_range) == parse_date(http_date(self.last_modified))):
+            if len(ranges.ranges) != 1:  # 不支持multipart/byteranges，返回全部内容
+                ranges = None
+            elif ranges.range_for_length(self.size) is None:
+                return self._reply(416, start_response, [('Content-Range', f'bytes */{self.size}')])
+            else:
+                start, stop = ranges.range_for_length(self.size)
+                code = 206
+                headers.append(('Content-Range', f'bytes {start}-{stop - 1}/{self.size}'))
+
+        headers.append(('Content-Length', str(stop - start)))
+        start_response(_status_line(code), headers)
+
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            self._close()
+            return []
+        if code == 200 and self.body is None and 'wsgi.file_wrapper' in environ:
+            return environ['wsgi.file_wrapper'](self.file, self.blocksize)
+        return self._iter_range(start, stop)
+
+    def _iter_range(self, start, stop):
+        """按blocksize逐块返回 [start, stop) 的内容，文件以mmap映射，不整体读入内存"""
+        if self.body is not None:
+            data = memoryview(self.body)
+            for i in range(start, stop, self.blocksize):
+                yield bytes(data[i:min(i + self.blocksize, stop)])
+            return
+
+        try:
+            if stop <= start:
+                return
+            with mmap(self.file.fileno(), 0, access=ACCESS_READ) as mm:
+                for i in range(start, stop, self.blocksize):
+                    yield mm[i:min(i + self.blocksize, stop)]
+        finally:
+            self.file.close()
+
+
+def send_file(path_or_file, mimetype=None, as_attachment=False, download_name=None,
+              last_modified=None, blocksize=64 * 1024):
+    """
+    以文件(或内存中的大块数据)作为响应，可直接从视图函数返回
+    支持Range断点续传、If-Modified-Since，并给出Content-Length与Last-Modified
+
+    :param path_or_file：文件路径、以二进制模式打开的文件对象，或 bytes/bytearray/memoryview
+    :param download_name：下载时的文件名，默认为路径中的文件名
+    :param last_modified：最后修改时间戳，文件默认取其mtime
+    """
+    if isinstance(path_or_file, (bytes, bytearray, memoryview)):
+        file, size = path_or_file, len(path_or_file)
+        last_modified = last_modified or time()
+    else:
+        if isinstance(path_or_file, (str, os.PathLike)):
+            file = open(path_or_file, 'rb')
+            download_name = download_name or os.path.basename(path_or_file)
+        else:
+            file = path_or_file
+        stat = os.fstat(file.fileno())
+        size = stat.st_size
+        last_modified = last_modified or stat.st_mtime
+
+    if mimetype is None and download_name:
+        mimetype = guess_type(download_name)[0]
+
+    headers = [
+        ('Content-Type', mimetype or 'application/octet-stream'),
+        ('Last-Modified', http_date(last_modified)),
+    ]
+    if as_attachment:
+        assert download_name, "作为附件下载时需要提供download_name"
+        headers.append(('Content-Disposition', f"attachment; filename*=UTF-8''{url_quote(download_name)}"))
+
+    return FileResponse(file, size, headers, last_modified, blocksize)
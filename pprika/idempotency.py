@@ -0,0 +1,126 @@
+from .context import request
+from .helpers import RawResponse, finalize_response, response_parts
+from .limiter import remote_addr
+from .restful import ApiException
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock, Event
+from hashlib import sha256
+from time import monotonic
+
+
+class IdempotencyConflict(ApiException):
+    """同一 Idempotency-Key 对应的请求体不同，或等待首个请求完成时超时"""
+
+    status = 422
+    message = 'Idempotency-Key 已被用于不同的请求'
+
+
+class _Entry(object):
+    __slots__ = ('fingerprint', 'response', 'expires', 'done')
+
+    def __init__(self, fingerprint):
+        self.fingerprint = fingerprint
+        self.response = None  # (body, status, headers)
+        self.expires = None
+        self.done = Event()
+
+
+class Idempotency(object):
+    """
+    按请求头 Idempotency-Key 对非GET请求去重，可作为装饰器用于视图函数、Resource的方法、
+    Resource.decorators 或 Api(decorators=[...])
+
+    首个请求的响应(状态、headers、body bytes)保存ttl秒，之后相同key的请求直接返回保存的响应而不执行视图；
+    首个请求仍在处理时，重复的请求等待其完成；首个请求出错或返回5xx时不保存，重试的请求将重新执行
+
+    key_func：区分客户端的键，与Idempotency-Key一同组成存储的键，避免不同用户的key冲突
+    max_keys：最多保存的key数，超出时淘汰最久未使用的
+    wait_timeout：重复请求等待首个请求完成的最长时间(秒)，超时返回 409
+    """
+
+    header = 'Idempotency-Key'
+
+    def __init__(self, ttl=24 * 3600, max_keys=10000, key_func=remote_addr,
+                 methods=('POST', 'PUT', 'PATCH', 'DELETE'), wait_timeout=30):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.key_func = key_func
+        self.methods = frozenset(methods)
+        self.wait_timeout = wait_timeout
+        self._store = OrderedDict()  # {(endpoint, client, key): _Entry}
+        self._lock = Lock()
+
+    def _claim(self, key, fingerprint):
+        """取出key对应的记录，没有(或已过期)则新建，返回 (entry, 是否为首个请求)"""
+        now = monotonic()
+        with self._lock:
+            entry = self._store.get(key)
+            if entry is not None and entry.expires is not None and entry.expires <= now:
+                del self._store[key]
+                entry = None
+
+            if entry is not None:
+                self._store.move_to_end(key)
+                return entry, False
+
+            entry = self._store[key] = _Entry(fingerprint)
+            if len(self._store) > self.max_keys:
+                self._store.popitem(last=False)
+            return entry, True
+
+    def _release(self, key, entry, response):
+        """首个请求完成，response为None表示不保存"""
+        with self._lock:
+            if response is None:
+                if self._store.get(key) is entry:
+                    del self._store[key]
+            else:
+                entry.response = response
+                entry.expires = monotonic() + self.ttl
+        entry.done.set()
+
+    @staticmethod
+    def _snapshot(response):
+        """取出可保存的响应内容，流式响应与5xx返回None"""
+        parts = response_parts(response)
+        if parts is None or parts[1].startswith('5'):
+            return None
+        body, status, headers = parts
+        return body, status, headers + [('Idempotent-Replayed', 'true')]
+
+    def _replay(self, entry):
+        body, status, headers = entry.response
+        return RawResponse(body, status, headers)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            idempotency_key = request.headers.get(self.header)
+            if not idempotency_key or request.method not in self.methods:
+                return func(*args, **kwargs)
+
+            key = request.rule.endpoint, self.key_func(), idempotency_key
+            fingerprint = sha256(request.get_data()).digest()
+
+            while True:
+                entry, first = self._claim(key, fingerprint)
+                if first:
+                    break
+                if entry.fingerprint != fingerprint:
+                    raise IdempotencyConflict()
+                timeout = request.remaining()
+                if not entry.done.wait(self.wait_timeout if timeout is None else timeout):
+                    raise IdempotencyConflict('相同 Idempotency-Key 的请求仍在处理中', 409)
+                if entry.response is not None:
+                    return self._replay(entry)
+                # 首个请求失败，记录已删除，由本请求重新执行
+
+            try:
+                response = finalize_response(func(*args, **kwargs))
+            except BaseException:
+                self._release(key, entry, None)
+                raise
+            self._release(key, entry, self._snapshot(response))
+            return response
+        return wrapper
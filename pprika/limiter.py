@@ -0,0 +1,111 @@
+from .context import request
+from .restful import ApiException
+from collections import OrderedDict
+from functools import wraps
+from threading import Lock
+from time import monotonic
+
+
+class TooManyRequests(ApiException):
+    """请求过于频繁时由 RateLimiter 抛出，可在构造 RateLimiter 时替换为其他子类"""
+
+    status = 429
+    message = 'Too Many Requests'
+
+
+def remote_addr():
+    """以客户端ip作为限流的键"""
+    return request.remote_addr
+
+
+def header(name):
+    """以请求头中的某一项(如令牌 AuthToken)作为限流的键，缺失时退回到ip"""
+    def key_func():
+        return request.headers.get(name) or request.remote_addr
+    return key_func
+
+
+class RateLimiter(object):
+    """
+    基于令牌桶的进程内限流器，可直接作为装饰器使用：
+    用于普通视图函数、Resource.decorators、Resource的单个方法，或 Api(decorators=[...]) 作用于整个Api
+
+    rate：每 per 秒补充的令牌数
+    burst：桶容量，即允许的突发请求数，默认等于rate
+    key_func：无参函数，返回区分客户端的键(ip、令牌、用户名等)
+    shards：分片数，每片一把锁，减少多线程下的锁竞争
+    exception_cls：拒绝时抛出的ApiException子类，经 Api.handle_error 处理
+
+    令牌在取用时按流逝时间惰性补充，无需定时线程；
+    每个分片的桶按最近一次取用排序，新建桶时从最旧的一端清除闲置至补满的桶(与新桶无异)，
+    分片仍满时直接丢弃最旧的桶，使每个分片至多 max_buckets 个桶，避免大量伪造的key撑大内存
+    """
+
+    def __init__(self, rate, per=1.0, burst=None, key_func=remote_addr,
+                 shards=16, exception_cls=TooManyRequests, max_buckets=1024):
+        assert rate > 0 and per > 0, "rate与per都应为正数"
+        self.rate = rate / per  # 每秒补充的令牌数
+        self.burst = float(burst or rate)
+        self.key_func = key_func
+        self.exception_cls = exception_cls
+        self.max_buckets = max_buckets  # 单个分片的桶数上限
+        self._idle = self.burst / self.rate  # 空桶补满所需时间
+        self._shards = [(Lock(), OrderedDict()) for _ in range(shards)]  # {key: bucket}，按最近取用排序
+
+    def hit(self, key, cost=1.0):
+        """
+        从key对应的桶中取出cost个令牌
+        成功返回0，否则返回还需等待的秒数
+        """
+        lock, buckets = self._shards[hash(key) % len(self._shards)]
+        now = monotonic()
+
+        with lock:
+            bucket = buckets.get(key)
+            if bucket is None:
+                self._evict(buckets, now)
+                bucket = buckets[key] = [self.burst, now]  # [剩余令牌, 上次更新时间]
+            else:
+                buckets.move_to_end(key)
+
+            tokens = bucket[0] + (now - bucket[1]) * self.rate
+            if tokens > self.burst:
+                tokens = self.burst
+            bucket[1] = now
+
+            if tokens < cost:
+                bucket[0] = tokens
+                return (cost - tokens) / self.rate
+            bucket[0] = tokens - cost
+            return 0
+
+    def _evict(self, buckets, now):
+        """
+        从最旧的一端清除已闲置到补满的桶，仍满时丢弃最旧的桶，调用时需持有该分片的锁
+        每个桶至多被清除一次，均摊O(1)
+        """
+        deadline = now - self._idle
+        while buckets:
+            oldest = next(iter(buckets.values()))
+            if oldest[1] > deadline:
+                break
+            buckets.popitem(last=False)
+        if len(buckets) >= self.max_buckets:
+            buckets.popitem(last=False)
+
+    def reset(self, key=None):
+        """清空key对应的桶，key为None时清空全部"""
+        for lock, buckets in self._shards:
+            with lock:
+                if key is None:
+                    buckets.clear()
+                else:
+                    buckets.pop(key, None)
+
+    def __call__(self, func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.hit(self.key_func()):
+                raise self.exception_cls()
+            return func(*args, **kwargs)
+        return wrapper
@@ -0,0 +1,145 @@
+from .context import request
+from .helpers import compact_dumps
+from collections import deque
+from threading import Thread, Event
+from traceback import format_exception
+from time import time, monotonic
+from random import random
+import atexit
+import sys
+
+
+class Logger(object):
+    """
+    异步、批量写出的结构化日志，包括访问日志与错误日志，每条记录为一行json
+
+    用法：Logger(app) 或 Logger(app, stream=open('pprika.log', 'a'))
+    请求线程只把记录放入队列(deque的append在GIL下是原子的，无需加锁)，
+    后台线程每隔flush_interval秒把队列中的记录格式化后一次写出；traceback也在后台线程格式化
+
+    queue_size：队列上限，满时新记录被丢弃并计入 dropped
+    access：是否记录访问日志
+    sample_rates：按异常类的采样率，如 {ValueError: 0.1}，按MRO查找，未给出的为1
+    tracebacks_per_minute：每个异常类每分钟最多记录的traceback数，超出的只记录异常类与信息
+
+    未创建Logger时app.logger为None，错误仍以print_exception输出
+    """
+
+    def __init__(self, app, stream=None, queue_size=10000, flush_interval=0.5,
+                 access=True, sample_rates=None, tracebacks_per_minute=10):
+        self.stream = stream or sys.stderr
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.access_enabled = access
+        self.sample_rates = dict(sample_rates or {})
+        self.tracebacks_per_minute = tracebacks_per_minute
+        self.dropped = 0  # 因队列满被丢弃的记录数
+        self.sampled_out = 0  # 因采样未记录的错误数
+        self._queue = deque()
+        self._rates = {}  # {exc_class: 采样率}，按MRO查找的结果
+        self._tracebacks = {}  # {exc_class: [窗口开始时间, 窗口内已记录数]}
+        self._closed = Event()
+        self._writer = Thread(target=self._run, name='pprika-logger', daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+        app.logger = self
+
+    def _put(self, record):
+        if len(self._queue) >= self.queue_size:
+            self.dropped += 1
+            return False
+        self._queue.append(record)
+        return True
+
+    def access(self, status, latency):
+        """记录一次请求，latency为秒"""
+        if not self.access_enabled:
+            return
+        rule = request.rule
+        self._put({
+            'type': 'access',
+            'time': time(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': rule.endpoint if rule else None,
+            'status': status,
+            'latency_ms': round(latency * 1000, 3),
+            'remote_addr': request.remote_addr,
+        })
+
+    def _sample_rate(self, cls):
+        rate = self._rates.get(cls)
+        if rate is None:
+            rate = next((self.sample_rates[c] for c in cls.__mro__ if c in self.sample_rates), 1)
+            self._rates[cls] = rate
+        return rate
+
+    def _allow_traceback(self, cls):
+        """每个异常类以一分钟为窗口限制traceback的数量，计数的竞争只会使数量略有出入"""
+        now = monotonic()
+        window = self._tracebacks.get(cls)
+        if window is None or now - window[0] >= 60:
+            window = self._tracebacks[cls] = [now, 0]
+        if window[1] >= self.tracebacks_per_minute:
+            return False
+        window[1] += 1
+        return True
+
+    def exception(self, e):
+        """记录未处理的异常，须在except块或已知e.__traceback__时调用"""
+        cls = type(e)
+        rate = self._sample_rate(cls)
+        if rate < 1 and random() >= rate:
+            self.sampled_out += 1
+            return
+
+        rule = request.rule
+        self._put({
+            'type': 'error',
+            'time': time(),
+            'method': request.method,
+            'path': request.path,
+            'endpoint': rule.endpoint if rule else None,
+            'exc': f'{cls.__module__}.{cls.__qualname__}',
+            'message': str(e),
+            'sample_rate': rate,
+            'traceback': e if self._allow_traceback(cls) else None,  # 由后台线程格式化
+        })
+
+    def _format(self, record):
+        e = record.get('traceback')
+        if e is not None:
+            record['traceback'] = ''.join(format_exception(type(e), e, e.__traceback__))
+        return compact_dumps(record)
+
+    def flush(self):
+        """写出队列中现有的全部记录"""
+        lines = []
+        queue = self._queue
+        while queue:
+            try:
+                record = queue.popleft()
+            except IndexError:
+                break
+            try:
+                lines.append(self._format(record))
+            except Exception as e:  # 单条记录无法序列化时不影响其他记录
+                lines.append(compact_dumps({'type': 'logger_error', 'message': repr(e)}))
+        if lines:
+            lines.append('')
+            try:
+                self.stream.write('\n'.join(lines))
+                self.stream.flush()
+            except (OSError, ValueError):
+                self.dropped += len(lines) - 1
+
+    def _run(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+        self.flush()
+
+    def close(self):
+        """停止后台线程并写出剩余的记录"""
+        if not self._closed.is_set():
+            self._closed.set()
+            self._writer.join()
@@ -0,0 +1,282 @@
+from .context import request
+from .helpers import make_response
+from werkzeug.exceptions import Forbidden, NotFound
+from threading import Lock, Thread, Condition, BoundedSemaphore, get_ident
+from collections import Counter
+from cProfile import Profile
+from pstats import Stats
+from random import random
+from marshal import dumps as marshal_dumps
+from time import time, sleep
+import tracemalloc
+import hmac
+import sys
+
+
+class _StackSampler(Thread):
+    """
+    低开销的栈采样器：仅在有被采样的请求时，每隔interval秒读取其线程的调用栈
+    采样结果以 collapsed stack('a;b;c' -> 次数) 的形式按endpoint累计
+    """
+
+    def __init__(self, interval):
+        super().__init__(name='pprika-stack-sampler', daemon=True)
+        self.interval = interval
+        self.active = {}  # {thread_id: endpoint}
+        self.counts = {}  # {endpoint: Counter({stack: n})}，读写都需持有counts_lock
+        self.counts_lock = Lock()
+        self._cond = Condition()
+
+    def watch(self, endpoint):
+        with self._cond:
+            self.active[get_ident()] = endpoint
+            self._cond.notify()
+
+    def unwatch(self):
+        with self._cond:
+            self.active.pop(get_ident(), None)
+
+    def run(self):
+        while True:
+            with self._cond:
+                while not self.active:
+                    self._cond.wait()  # 无采样请求时不占用CPU
+                active = dict(self.active)
+
+            frames = sys._current_frames()
+            stacks = [(endpoint, self._collapse(frames[tid])) for tid, endpoint in active.items() if tid in frames]
+            with self.counts_lock:
+                for endpoint, stack in stacks:
+                    self.counts.setdefault(endpoint, Counter())[stack] += 1
+            sleep(self.interval)
+
+    @staticmethod
+    def _collapse(frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f'{code.co_filename}:{code.co_name}:{code.co_firstlineno}')
+            frame = frame.f_back
+        return ';'.join(reversed(stack))
+
+
+class Profiler(object):
+    """
+    按需对单个请求/endpoint进行性能分析，结果按endpoint在内存中累计
+
+    用法：profiler = Profiler(app, secret='...')，再 profiler.enable('v1.voicelist', rate=0.1)
+    或在请求头中带上 profiler.sign() 生成的签名，强制分析该次请求
+
+    mode：'cprofile' 使用cProfile，可下载pstats文件；'stack' 使用栈采样，可下载collapsed stack文件
+          'memory' 使用tracemalloc，统计峰值、请求结束后仍存活的内存及主要分配位置，以json查看
+          tracemalloc追踪整个进程且不区分线程，memory模式下同一时刻只分析一个请求，
+          但同时在其他线程处理的请求的分配也会计入，结果是该请求期间整个进程的数值，
+          要得到准确的单个endpoint数值应在单线程(或并发很低)的worker上分析
+    max_concurrent：同时被分析的请求数上限，超出的请求不做分析，以限制开销
+    url_prefix：下载结果的管理路由前缀，访问时同样需要带签名请求头
+
+    未创建Profiler时app.profiler为None，请求处理无额外开销
+    """
+
+    header = 'X-PPrika-Profile'
+    sign_expires = 300  # 签名有效期(秒)
+
+    def __init__(self, app, secret, mode='cprofile', max_concurrent=4,
+                 interval=0.005, url_prefix='/_profiler', top_sites=20):
+        assert mode in ('cprofile', 'stack', 'memory'), "mode只能是 'cprofile'、'stack' 或 'memory'"
+        if mode == 'memory':
+            max_concurrent = 1
+        self.secret = secret.encode() if isinstance(secret, str) else secret
+        self.mode = mode
+        self.endpoints = {}  # {endpoint: sample_rate}
+        self.stats = {}  # {endpoint: pstats.Stats}
+        self.memory = {}  # {endpoint: {'peak': 最大峰值, 'peak_total', 'retained_total', 'sites': Counter}}
+        self.requests = Counter()  # {endpoint: 被分析的请求数}
+        self.top_sites = top_sites
+        self._lock = Lock()
+        self._slots = BoundedSemaphore(max_concurrent)
+        self._sampler = _StackSampler(interval) if mode == 'stack' else None
+        self.init_app(app, url_prefix)
+
+    def init_app(self, app, url_prefix):
+        app.profiler = self
+        url_prefix = url_prefix.rstrip('/')
+        app.add_url_rule(url_prefix + '/', '_profiler_index', self._index_view)
+        app.add_url_rule(url_prefix + '/<string:endpoint>/pstats', '_profiler_pstats', self._pstats_view)
+        app.add_url_rule(url_prefix + '/<string:endpoint>/collapsed', '_profiler_collapsed', self._collapsed_view)
+        app.add_url_rule(url_prefix + '/<string:endpoint>/memory', '_profiler_memory', self._memory_view)
+
+    def enable(self, endpoint, rate=0.01):
+        """以rate的概率分析该endpoint的请求"""
+        self.endpoints[endpoint] = rate
+
+    def disable(self, endpoint=None):
+        """停止分析该endpoint，endpoint为None时停止全部"""
+        if endpoint is None:
+            self.endpoints.clear()
+        else:
+            self.endpoints.pop(endpoint, None)
+
+    def reset(self):
+        with self._lock:
+            self.stats.clear()
+            self.memory.clear()
+            self.requests.clear()
+            if self._sampler is not None:
+                with self._sampler.counts_lock:
+                    self._sampler.counts.clear()
+
+    def sign(self, timestamp=None):
+        """生成签名请求头的值：'时间戳.签名'"""
+        ts = str(int(timestamp or time()))
+        sig = hmac.new(self.secret, ts.encode(), 'sha256').hexdigest()
+        return f'{ts}.{sig}'
+
+    def verify(self, value):
+        if not value or '.' not in value:
+            return False
+        ts, _ = value.split('.', 1)
+        if not ts.isdigit() or abs(time() - int(ts)) > self.sign_expires:
+            return False
+        return hmac.compare_digest(value, self.sign(ts))
+
+    def _should_profile(self, endpoint):
+        rate = self.endpoints.get(endpoint)
+        if rate is not None and random() < rate:
+            return True
+        return self.header in request.headers and self.verify(request.headers[self.header])
+
+    def dispatch(self, app):
+        """由 'app.wsgi_app' 代替 dispatch_request 调用，对命中采样的请求进行分析"""
+        endpoint = request.rule.endpoint if request.rule else None
+        if endpoint is None or endpoint.startswith('_profiler') or not self._should_profile(endpoint):
+            return app.dispatch_request()
+
+        if not self._slots.acquire(blocking=False):
+            return app.dispatch_request()  # 同时分析的请求已达上限
+        try:
+            if self.mode == 'memory':
+                return self._trace_memory(app, endpoint)
+            if self._sampler is not None:
+                return self._sample(app, endpoint)
+            return self._profile(app, endpoint)
+        finally:
+            self._slots.release()
+
+    def _profile(self, app, endpoint):
+        profile = Profile()
+        profile.enable()
+        try:
+            return app.dispatch_request()
+        finally:
+            profile.disable()
+            with self._lock:
+                stats = self.stats.get(endpoint)
+                if stats is None:
+                    self.stats[endpoint] = Stats(profile)
+                else:
+                    stats.add(profile)
+                self.requests[endpoint] += 1
+
+    def _sample(self, app, endpoint):
+        if not self._sampler.is_alive():
+            with self._lock:
+                if not self._sampler.is_alive():
+                    self._sampler.start()
+        self._sampler.watch(endpoint)
+        try:
+            return app.dispatch_request()
+        finally:
+            self._sampler.unwatch()
+            with self._lock:
+                self.requests[endpoint] += 1
+
+    def _trace_memory(self, app, endpoint):
+        """
+        若tracemalloc未启动则仅在该请求期间启动，结束时仍被追踪的内存即为该请求留存的内存
+        已启动(如由用户启动)时则与请求前的快照比较
+        """
+        filters = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__))
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+            before = None
+        else:
+            before = tracemalloc.take_snapshot().filter_traces(filters)  # 两次快照同样过滤，否则差值中混入快照自身的分配
+        tracemalloc.reset_peak()
+
+        try:
+            return app.dispatch_request()
+        finally:
+            _, peak = tracemalloc.get_traced_memory()
+            snapshot = tracemalloc.take_snapshot().filter_traces(filters)
+            if started:
+                tracemalloc.stop()
+                sites = [(stat.traceback[0], stat.size) for stat in snapshot.statistics('lineno')]
+            else:
+                sites = [(stat.traceback[0], stat.size_diff) for stat in snapshot.compare_to(before, 'lineno')]
+            self._add_memory(endpoint, peak, sites)
+
+    def _add_memory(self, endpoint, peak, sites):
+        with self._lock:
+            record = self.memory.get(endpoint)
+            if record is None:
+                record = self.memory[endpoint] = {'peak': 0, 'peak_total': 0, 'retained_total': 0, 'sites': Counter()}
+            record['peak'] = max(record['peak'], peak)
+            record['peak_total'] += peak
+            for frame, size in sites:
+                record['retained_total'] += size
+                record['sites'][f'{frame.filename}:{frame.lineno}'] += size
+            self.requests[endpoint] += 1
+
+    def _check_auth(self):
+        if not self.verify(request.headers.get(self.header)):
+            raise Forbidden()
+
+    def _index_view(self):
+        self._check_auth()
+        return {'mode': self.mode, 'enabled': self.endpoints, 'requests': dict(self.requests)}
+
+    def _pstats_view(self, endpoint):
+        self._check_auth()
+        with self._lock:
+            stats = self.stats.get(endpoint)
+            if stats is None:
+                raise NotFound()
+            data = marshal_dumps(stats.stats)  # 与 Stats.dump_stats 写出的文件格式一致
+        return self._attachment(data, f'{endpoint}.pstats')
+
+    def _collapsed_view(self, endpoint):
+        self._check_auth()
+        counts = None
+        if self._sampler is not None:
+            with self._sampler.counts_lock:  # 采样线程同时在更新counts
+                counts = dict(self._sampler.counts.get(endpoint, ()))
+        if not counts:
+            raise NotFound()
+        lines = (f'{stack} {n}' for stack, n in counts.items())
+        return self._attachment('\n'.join(lines).encode(), f'{endpoint}.collapsed')
+
+    def _memory_view(self, endpoint):
+        self._check_auth()
+        with self._lock:
+            record = self.memory.get(endpoint)
+            if record is None:
+                raise NotFound()
+            n = self.requests[endpoint]
+            return {
+                'scope': 'process',  # 包括同时在其他线程处理的请求，见Profiler的说明
+                'requests': n,
+                'peak_max': record['peak'],
+                'peak_avg': record['peak_total'] // n,
+                'retained_avg': record['retained_total'] // n,
+                'top_sites': record['sites'].most_common(self.top_sites),
+            }
+
+    @staticmethod
+    def _attachment(data, filename):
+        headers = {
+            'Content-Type': 'application/octet-stream',
+            'Content-Disposition': f'attachment; filename="{filename}"',
+        }
+        return make_response((data, 200, headers))
@@ -1,12 +1,8 @@
 from .blueprint import Blueprint
-from functools import partial
-from .context import request
-from .helpers import make_response
+from .context import request, current_app
+from .helpers import make_response, response_parts, RawResponse
 from werkzeug.exceptions import HTTPException
-from sys import exc_info
-from traceback import print_exception
 from werkzeug.datastructures import FileStorage
-from decimal import Decimal
 
 
 class ApiException(Exception):
@@ -19,10 +15,41 @@ class ApiException(Exception):
     可重写 'get_response' 并将自定义子类在初始化Api时作为参数传入，定制错误处理响应格式
     如 api = Api('api', exception_cls=CustomException)
     注意：添加的自定义属性都应当在__init__中初始化
+
+    实例属性都与类属性相同时(如 raise NotLogin())，to_response 将复用每个类只生成一次的响应体bytes与headers，
+    因此 'get_response' 的结果应只取决于实例属性；否则可将 cache_response 设为False
     """
 
     status = None
     message = None
+    cache_response = True
+    _missing = object()
+
+    def _is_default(self):
+        """实例属性是否都等于类的默认值"""
+        cls = type(self)
+        for name, value in self.__dict__.items():
+            if getattr(cls, name, self._missing) != value:
+                return False
+        return True
+
+    def to_response(self):
+        """
+        供 'Api.handle_error' 等调用，返回该异常对应的响应
+        默认实例的响应预先编码为 RawResponse(响应体、状态行与header列表)存于类上，之后每次raise直接复用
+        """
+        cls = type(self)
+        if not self.cache_response or not self._is_default():
+            return self.get_response()
+
+        cached = cls.__dict__.get('_cached_response')
+        if cached is None:
+            response = self.get_response()
+            parts = response_parts(response)
+            if parts is None:  # 流式响应无法复用
+                return response
+            cached = cls._cached_response = RawResponse(*parts)
+        return cached
 
     def __init__(self, message=None, status=None):
         self.message = message or self.message
@@ -48,33 +75,27 @@ class Api(Blueprint):
     """
     与flask-restful不同，Api作为Blueprint子类直接绑定于app
     与Blueprint差别：Api不使用全局错误处理器，且错误默认以json响应
+    decorators：作用于该Api下所有视图函数的装饰器列表，如限流、鉴权
+    envelope：helpers.Envelope实例，为该Api下所有视图函数的返回值套上统一的外壳
     """
 
     exception_cls = ApiException
 
-    def __init__(self, name, url_prefix=None, exception_cls=None):
+    def __init__(self, name, url_prefix=None, exception_cls=None, decorators=None, envelope=None):
         super().__init__(name, url_prefix)
         if exception_cls is not None:
             self.exception_cls = exception_cls
-        self._deferred_funcs.append(lambda a: self._init_app(a))
+        self.decorators = list(decorators or [])
+        self.envelope = envelope
+        self._defer(lambda a: self._init_app(a))
 
     def _init_app(self, app):
-        if not app.api_set:
-            app.handle_exception = partial(self._error_router, app.handle_exception)
-            # 若自身未设置对应错误处理器，则错误由handle_user_exception中再抛出
-        app.api_set.add(self.name)
-
-    def _error_router(self, original_handler, e):
         """
-        若错误来自api内部，则以自带处理器处理
-        否则交由源(app)处理器处理
-        通过重写(override)该方法可扩大handle_error处理范围
-        404/405类路由错误 request.__load__ 还未执行，blueprint为None，不被认为是Api内的错误
+        将自身登记到 app.error_routers，来自本api的错误由 'app.handle_exception' 转交 handle_error
+        若自身未设置对应错误处理器，则错误由handle_user_exception中再抛出
         """
-        if request.blueprint == self.name:
-            return self.handle_error(e)
-            # api中的错误不使用original_handler
-        return original_handler(e)
+        app.api_set.add(self.name)
+        app.error_routers[self.name] = self.handle_error
 
     def handle_error(self, e):
         """
@@ -89,9 +110,28 @@ class Api(Blueprint):
         elif isinstance(e, ApiException):
             e = self.exception_cls(e.message, e.status)
         else:
-            print_exception(*exc_info())
-            e = self.exception_cls(500, repr(e))
-        return e.get_response()
+            current_app.log_exception(e)
+            e = self.exception_cls(repr(e), 500)
+        return e.to_response()
+
+    def add_url_rule(self, path, endpoint=None, view_func=None, **options):
+        """
+        在Blueprint同名方法的基础上，为view_func套上 self.envelope 与 self.decorators
+        endpoint需在套装饰器前确定，避免被装饰器改名
+        """
+        if endpoint is None and view_func is not None:
+            endpoint = view_func.__name__
+
+        if view_func is not None:
+            if self.envelope is not None:
+                view_func = self.envelope(view_func)
+            for decorator in self.decorators:
+                view_func = decorator(view_func)
+        if options.get('head') is not None:
+            for decorator in self.decorators:  # HEAD处理函数同样需要鉴权等
+                options['head'] = decorator(options['head'])
+
+        super().add_url_rule(path, endpoint, view_func, **options)
 
     def add_resource(self, resource, path, **kwargs):
         """
@@ -108,6 +148,7 @@ class Api(Blueprint):
             kwargs['methods'] = resource.get_views()
 
         self.add_url_rule(path, endpoint, view_func, **kwargs)
+        self._defer(lambda a: resource.freeze_views())
 
 
 class Resource(object):
@@ -117,11 +158,22 @@ class Resource(object):
     用法：继承该类，并添加与method同名的视图函数作为其方法
     将视图函数的装饰器作为列表赋给 cls.decorators，对该Resource内所有方法都适用
 
+    可定义以 'head_response' 只返回headers的head方法，否则HEAD请求使用get方法
+
     注意：当被路由时若无对应method的方法将导致 405 Method Not Allowed
     且类里除了视图函数以外不宜有其他方法，尤其是名字里带下划线 "_" 的
     该类初始化(__init__调用时)暂不支持传参
     """
     decorators = []
+    _method_map = None  # {method: func}，由 freeze_views 在app冻结时生成
+
+    @classmethod
+    def freeze_views(cls):
+        """预先生成method到处理函数的映射，HEAD无对应方法时使用GET的"""
+        method_map = {m: getattr(cls, m) for m in cls.get_views()}
+        if 'get' in method_map:
+            method_map.setdefault('head', method_map['get'])
+        cls._method_map = method_map
 
     @classmethod
     def get_views(cls):
@@ -135,10 +187,14 @@ class Resource(object):
         404/405等路由错误在 url_rule.match 时就发生，无需也无法在此处理
         """
         method = request.method.lower()
+        method_map = cls.__dict__.get('_method_map')  # 不使用父类的映射
 
-        func = getattr(cls, method, None)
-        if func is None and method == 'head':
-            func = getattr(cls, 'get', None)
+        if method_map is not None:
+            func = method_map.get(method)
+        else:
+            func = getattr(cls, method, None)
+            if func is None and method == 'head':
+                func = getattr(cls, 'get', None)
 
         return func(cls(), *args, **kwargs)
 
@@ -155,6 +211,63 @@ class Namespace(dict):
         self[name] = value
 
 
+class Record(object):
+    """
+    由 'make_record' 生成的定长记录类的基类
+    字段固定、使用__slots__，直接以属性访问，比Namespace省内存
+    为兼容旧代码也支持 record['name'] 的访问方式，需要dict时再调用 to_dict
+    """
+    __slots__ = ()
+    _fields = ()
+
+    def __init__(self, **kwargs):
+        for name in self._fields:
+            setattr(self, name, kwargs.pop(name, None))
+        if kwargs:
+            raise TypeError(f"{type(self).__name__} 没有字段: {', '.join(kwargs)}")
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name)
+
+    def __setitem__(self, name, value):
+        if name not in self._fields:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in self._fields else default
+
+    def keys(self):
+        return self._fields
+
+    def update(self, other):
+        for name in other.keys():
+            self[name] = other[name]
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self._fields}
+
+    def __repr__(self):
+        fields = ', '.join(f'{name}={getattr(self, name)!r}' for name in self._fields)
+        return f'{type(self).__name__}({fields})'
+
+
+_record_classes = {}  # {(name, fields): record_cls}
+
+
+def make_record(name, fields):
+    """生成(或取出已生成的)名为name、字段为fields的Record子类"""
+    fields = tuple(fields)
+    key = name, fields
+    cls = _record_classes.get(key)
+    if cls is None:
+        cls = _record_classes[key] = type(name, (Record,), {'__slots__': fields, '_fields': fields})
+    return cls
+
+
 _friendly_location = {
     u'json': u'the JSON body',
     u'form': u'the post body',
@@ -165,6 +278,12 @@ _friendly_location = {
     u'files': u'an uploaded file',
 }
 
+_batch_types = (int, float)  # 列表参数中可整体批量转化的类型
+
+
+def _identity(value):
+    return value
+
 
 class Argument(object):
     """
@@ -174,10 +293,20 @@ class Argument(object):
     dest：参数解析后在Namespace里对应的键名，相当于换了个名字
     location：该参数所处位置/格式，如queryString、requestBody之类的，其中靠后的优先(多值时会覆盖前面的)
     nullable：允不允许请求中的参数值为Null(None)
+    action：'store' 只取最后一个合法值；'append' 收集所有值为列表，type=list[int] 时自动为 'append'
+    max_items：action为 'append' 时列表长度上限
     """
 
-    def __init__(self, name, dest=None, default=None, required=False,
-                 type=str, location=('json', 'values',), nullable=True):
+    def __init__(self, name, dest=None, default=None, required=False, type=str,
+                 location=('json', 'values',), nullable=True, action='store', max_items=None):
+        if getattr(type, '__origin__', None) is list:  # list[int]
+            type, = type.__args__
+            action = 'append'
+        elif type is list:
+            type = _identity
+            action = 'append'
+
+        assert action in ('store', 'append'), "action只能是 'store' 或 'append'"
         self.name = name
         self.dest = dest
         self.default = default
@@ -185,6 +314,8 @@ class Argument(object):
         self.type = type
         self.location = (location,) if isinstance(location, str) else location
         self.nullable = nullable
+        self.action = action
+        self.max_items = max_items
 
     def __str__(self):
         return f"Argument 'name: {self.name}, type: {self.type}'"
@@ -200,15 +331,37 @@ class Argument(object):
         elif isinstance(value, FileStorage) and self.type == FileStorage:
             return value
 
-        if self.type is Decimal:
+        if getattr(self.type, '__module__', None) == 'decimal':  # Decimal先转为str避免float的误差，无需导入decimal模块
             return self.type(str(value))
         else:
             return self.type(value)
 
-    def handle_validation_error(self, error, bundle_errors):
-        """根据bundle_errors决定抛出异常或将其返回收集"""
+    def convert_list(self, values):
+        """
+        批量转化列表参数，int/float先尝试整体map转化
+        失败时再逐个转化，返回 (结果列表, {下标: 错误信息})
+        """
+        if self.type in _batch_types:
+            try:
+                return list(map(self.type, values)), None
+            except (TypeError, ValueError):
+                pass
+
+        result, errors = [], {}
+        for i, value in enumerate(values):
+            try:
+                result.append(self.convert(value))
+            except Exception as e:
+                errors[i] = str(e)
+        return result, errors
+
+    def handle_validation_error(self, error, bundle_errors, detail=None):
+        """
+        根据bundle_errors决定抛出异常或将其返回收集
+        detail：代替str(error)作为错误信息，如列表参数各元素的错误
+        """
 
-        msg = {self.name: str(error)}
+        msg = {self.name: str(error) if detail is None else detail}
         if bundle_errors:
             return error, msg
         raise ApiException(message=msg, status=400)
@@ -238,6 +391,9 @@ class Argument(object):
             values.extend(value)
             # value为None说明请求中该name对应的value就是None
 
+        if self.action == 'append':
+            return self.parse_list(values, bundle_errors)
+
         for value in values:
             try:
                 value = self.convert(value)
@@ -245,18 +401,43 @@ class Argument(object):
                 return self.handle_validation_error(e, bundle_errors)
             result = value or result
 
-        if not result and self.required:  # 必需参数缺失
+        if not result:
+            return self.handle_missing(bundle_errors)
+        return result, None  # None表示无错误信息
+
+    def parse_list(self, values, bundle_errors=False):
+        """action为 'append' 时由parse调用，json中的列表值会被展开"""
+
+        items = []
+        for value in values:
+            if isinstance(value, list):
+                items.extend(value)
+            else:
+                items.append(value)
+
+        if not items:
+            return self.handle_missing(bundle_errors)
+        if self.max_items is not None and len(items) > self.max_items:
+            error = ValueError(f'最多只能有 {self.max_items} 个值，实际为 {len(items)} 个')
+            return self.handle_validation_error(error, bundle_errors)
+
+        result, errors = self.convert_list(items)
+        if errors:
+            return self.handle_validation_error(ValueError(errors), bundle_errors, errors)
+        return result, None
+
+    def handle_missing(self, bundle_errors=False):
+        """参数缺失时，必需参数报错，非必需参数以默认值代替"""
+
+        if self.required:
             locations = [_friendly_location.get(loc, loc) for loc in self.location]
             msg = f"Missing in {' or '.join(locations)}"
             return self.handle_validation_error(KeyError(msg), bundle_errors)
 
-        if not result:  # 非必需缺失，以默认值代替
-            if callable(self.default):
-                return self.default(), None
-            else:
-                return self.default, None
-
-        return result, None  # None表示无错误信息
+        if callable(self.default):
+            return self.default(), None
+        else:
+            return self.default, None
 
 
 class RequestParser(object):
@@ -270,14 +451,15 @@ class RequestParser(object):
         self.bundle_errors = bundle_errors
 
     @staticmethod
-    def get_all_args(req):
+    def get_all_args(req, with_files=True):
         """
         返回 req 较有可能是参数的key，之后每parse一个就弹出
         若最后不为空则说明请求中含有多余的参数
+        with_files为False时不检查上传的文件
         """
 
         arg_keys = set()
-        for loc in ['json', 'values', 'files']:
+        for loc in ('json', 'values', 'files') if with_files else ('json', 'values'):
             # request并不都是请求参数，如cookies、headers部分键值是每次请求都固定的
             value = getattr(req, loc, None)
 
@@ -304,18 +486,32 @@ class RequestParser(object):
 
         return self
 
-    def parse_args(self, req=request, strict=False, http_error_code=400):
+    def make_record(self, name='Record', extra_fields=()):
+        """
+        以已添加参数的 dest(或name) 加上 extra_fields 作为字段，生成Record子类
+        可作为 parse_args 的 record_cls 参数
+        """
+        fields = [arg.dest or arg.name for arg in self.args]
+        fields.extend(f for f in extra_fields if f not in fields)
+        return make_record(name, fields)
+
+    def parse_args(self, req=request, strict=False, http_error_code=400, record_cls=None):
         """
         从req中解析所有添加的参数，并以Namespace(可看作dict)返回
+        没有参数的location含 'files' 且表单尚未解析时，上传文件的内容被丢弃，之后 req.files 中的文件为空
 
         :param req: 覆盖原有的全局request进行参数解析
         :param strict: 若req未提供必需的参数，则抛出 BadRequest 400 错误
         :param http_error_code：bundle_errors为True时使用的默认错误码
+        :param record_cls：由 make_record 生成的Record子类，给出时以其实例代替Namespace返回
         """
 
         namespace = Namespace()
         errors = {}
-        req.arg_keys = self.get_all_args(req) if strict else set()
+        with_files = any('files' in arg.location for arg in self.args)
+        if not with_files and hasattr(req, 'discard_uploads'):
+            req.discard_uploads()  # 没有文件参数时，解析表单只读取普通字段，丢弃上传文件的内容
+        req.arg_keys = self.get_all_args(req, with_files) if strict else set()
 
         for arg in self.args:
             value, msg = arg.parse(req, self.bundle_errors)  # 若bundle_errors为False，异常将直接抛出
@@ -331,4 +527,6 @@ class RequestParser(object):
             msg = '未知参数: %s' % ', '.join(req.arg_keys)
             raise ApiException(message=msg, status=400)
 
+        if record_cls is not None:
+            return record_cls(**namespace)
         return namespace
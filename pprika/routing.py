@@ -0,0 +1,163 @@
+from werkzeug.routing import Rule
+from hashlib import sha1, sha256
+from json import dumps, loads
+import hmac
+import werkzeug
+import glob
+import sys
+import re
+import os
+
+
+class CachedRule(Rule):
+    """
+    可推迟编译、并可从 RouteCache 恢复编译结果的Rule
+    deferred为True时加入Map不立即编译，由 'RouteCache.compile' 在app冻结时统一编译
+    从缓存恢复的rule，其builder(url_for所用)由werkzeug在首次build时生成
+    """
+
+    deferred = False
+
+    def compile(self):
+        if self.deferred:
+            return
+        self._converter_specs = []  # [(变量名, converter名, args, kwargs)]，供缓存时重建converter
+        super().compile()
+
+    def get_converter(self, variable_name, converter_name, args, kwargs):
+        self._converter_specs.append((variable_name, converter_name, args, kwargs))
+        return super().get_converter(variable_name, converter_name, args, kwargs)
+
+    def _build(self, **values):
+        """恢复的rule首次build时才生成builder，compile生成的builder作为实例属性覆盖此方法"""
+        self._build = self._compile_builder(False).__get__(self, None)
+        return self._build(**values)
+
+    def _build_unknown(self, **values):
+        self._build_unknown = self._compile_builder(True).__get__(self, None)
+        return self._build_unknown(**values)
+
+    def cache_key(self):
+        """影响编译结果的rule属性，带defaults的rule不缓存"""
+        if self.defaults:
+            return None
+        return self.rule, self.host, self.subdomain, self.strict_slashes, self.merge_slashes, self.build_only
+
+    def dump(self):
+        """编译结果中可json序列化的数据，不含builder"""
+        regex = None if self.build_only else self._regex.pattern
+        return [regex, self._trace, self._static_weights, self._argument_weights,
+                sorted(self.arguments), self._converter_specs]
+
+    def restore(self, entry):
+        regex, trace, static_weights, argument_weights, arguments, converters = entry
+        converters = [(variable, name, tuple(args), kwargs) for variable, name, args, kwargs in converters]
+        self._converters = {
+            variable: super(CachedRule, self).get_converter(variable, name, args, kwargs)
+            for variable, name, args, kwargs in converters
+        }
+        self._regex = None if regex is None else re.compile(regex, re.UNICODE)
+        self._trace = [(bool(dynamic), data) for dynamic, data in trace]
+        self._static_weights = [(int(index), int(weight)) for index, weight in static_weights]
+        self._argument_weights = [int(weight) for weight in argument_weights]
+        self._converter_specs = converters
+        self.arguments.update(arguments)
+
+
+class RouteCache(object):
+    """
+    路由表编译结果的磁盘缓存，省去启动时为每个rule生成builder(AST编译)的耗时，正则仍需re.compile
+
+    用法：app.route_cache = RouteCache('.route_cache')，须在注册路由之前设置
+    缓存文件以 rule集合、Map设置、converter、python与werkzeug版本 的哈希命名，任一改变即不再使用旧文件；
+    写入新文件时删除同目录下的旧文件
+
+    文件为json，只含trace、权重、正则与converter参数等数据，不含代码；builder在首次url_for时由werkzeug生成
+    key：给出时以其对文件做HMAC签名，签名不符的文件被忽略，防止可写入该目录者篡改路由
+    文件内容不合预期(如werkzeug内部结构改变)时，该rule照常编译
+    """
+
+    prefix = 'routes-'
+    suffix = '.json'
+
+    def __init__(self, directory, key=None):
+        self.directory = directory
+        self.key = key.encode() if isinstance(key, str) else key
+        self._pending = []  # 推迟编译的rule
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _environment(url_map):
+        converters = sorted((name, f'{cls.__module__}.{cls.__qualname__}') for name, cls in url_map.converters.items())
+        return (sys.implementation.cache_tag, werkzeug.__version__, url_map.host_matching,
+                url_map.charset, url_map.default_subdomain, converters)
+
+    def _path(self, url_map, keys):
+        digest = sha1(repr((self._environment(url_map), sorted(keys, key=repr))).encode()).hexdigest()
+        return os.path.join(self.directory, f'{self.prefix}{digest[:20]}{self.suffix}')
+
+    def _sign(self, data):
+        if self.key is None:
+            return b''
+        return hmac.new(self.key, data, sha256).hexdigest().encode()
+
+    def _load(self, path):
+        """返回 {cache_key: entry}，文件不存在、损坏或签名不符时返回None"""
+        try:
+            with open(path, 'rb') as f:
+                signature, _, data = f.read().partition(b'\n')
+            if not hmac.compare_digest(signature, self._sign(data)):
+                return None
+            return {tuple(key): entry for key, entry in loads(data)}
+        except (OSError, ValueError, TypeError):
+            return None
+
+    def _save(self, path, entries):
+        os.makedirs(self.directory, exist_ok=True)
+        data = dumps([[key, entry] for key, entry in entries.items()], separators=(',', ':')).encode()
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(self._sign(data) + b'\n' + data)
+        os.replace(tmp, path)
+        for old in glob.glob(os.path.join(self.directory, f'{self.prefix}*{self.suffix}')):
+            if old != path:
+                try:
+                    os.remove(old)
+                except OSError:
+                    pass
+
+    def defer(self, rule):
+        """在rule加入Map前调用，使其推迟到 'compile' 时编译"""
+        rule.deferred = True
+        self._pending.append(rule)
+
+    def compile(self, url_map):
+        """编译推迟的rule，有缓存的直接恢复，全部编译后写入新的缓存文件"""
+        rules, self._pending = self._pending, []
+        keys = [rule.cache_key() for rule in rules]  # Rule定义了__eq__，不可作为dict的键
+        path = self._path(url_map, [key for key in keys if key is not None])
+        cached = self._load(path) or {}
+
+        entries, compiled = {}, False
+        for rule, key in zip(rules, keys):
+            rule.deferred = False
+            entry = cached.get(key) if key is not None else None
+            if entry is not None:
+                try:
+                    rule.restore(entry)
+                    self.hits += 1
+                except Exception:  # 缓存内容不合预期时照常编译
+                    entry = None
+            if entry is None:
+                rule.compile()
+                self.misses += 1
+                compiled = True
+            if key is not None:
+                entries[key] = entry or rule.dump()
+
+        if entries and (compiled or len(cached) != len(entries)):
+            try:
+                self._save(path, entries)
+            except OSError:
+                pass  # 目录不可写时仅不缓存
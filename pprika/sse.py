@@ -0,0 +1,152 @@
+from .context import request
+from .helpers import RawResponse, compact_dumps
+from collections import deque
+from threading import Lock, Condition
+from itertools import count
+
+
+class Subscription(object):
+    """
+    Broker的一个订阅者，拥有有界队列
+    队列满(消费过慢)时被Broker踢出，之后迭代将结束，客户端可带 Last-Event-ID 重连补回
+    """
+
+    def __init__(self, broker, maxsize):
+        self.broker = broker
+        self.maxsize = maxsize
+        self.queue = deque()
+        self.closed = False
+        self._cond = Condition(Lock())
+
+    def put(self, frame):
+        """由Broker调用，返回False表示队列已满"""
+        with self._cond:
+            if len(self.queue) >= self.maxsize:
+                return False
+            self.queue.append(frame)
+            self._cond.notify()
+            return True
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify()
+
+    def frames(self, keepalive, retry=3000):
+        """
+        逐个返回事件帧，keepalive秒无事件时返回注释帧保活，以便及时发现断开的连接
+        首帧立即给出重连间隔retry(毫秒)，使服务器马上发出响应头
+        """
+        try:
+            yield f'retry: {retry}\n\n'.encode()
+            while True:
+                with self._cond:
+                    if not self.queue and not self.closed:
+                        self._cond.wait(keepalive)
+                    if self.closed and not self.queue:
+                        return
+                    frames = list(self.queue)
+                    self.queue.clear()
+
+                if not frames:
+                    yield b': ping\n\n'
+                for frame in frames:
+                    yield frame
+        finally:
+            self.broker.unsubscribe(self)
+
+
+class EventStream(RawResponse):
+    """text/event-stream 响应，以生成器逐帧返回，body为Subscription"""
+    __slots__ = ('keepalive',)
+
+    def __init__(self, subscription, keepalive):
+        headers = [
+            ('Content-Type', 'text/event-stream; charset=utf-8'),
+            ('Cache-Control', 'no-cache'),
+            ('X-Accel-Buffering', 'no'),  # 禁止nginx缓冲
+        ]
+        super().__init__(subscription, '200 OK', headers)
+        self.keepalive = keepalive
+
+    def __call__(self, environ, start_response):
+        start_response(self.status, self.headers)
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            self.body.broker.unsubscribe(self.body)
+            return []
+        return self.body.frames(self.keepalive)
+
+
+class Broker(object):
+    """
+    进程内的发布/订阅中心，用于Server-Sent Events推送
+
+    用法：
+    broker = Broker()
+    视图中 return broker.stream() 作为SSE端点，其他视图中 broker.publish(data, event='voice')
+
+    history：保留最近的事件数，用于客户端断线重连时按 Last-Event-ID 补发
+    queue_size：每个订阅者队列上限，超出时该订阅者被踢出
+    每个事件只编码一次，所有订阅者共享同一份bytes
+
+    流以生成器实现，在线程模式的服务器中每个连接占用一个线程；
+    在gevent/eventlet等协程服务器中，等待事件时只挂起协程
+    """
+
+    def __init__(self, history=1000, queue_size=100, keepalive=15):
+        self.history = deque(maxlen=history)  # [(id, frame)]
+        self.queue_size = queue_size
+        self.keepalive = keepalive
+        self.subscribers = set()
+        self.evicted = 0  # 因消费过慢被踢出的订阅者数
+        self._ids = count(1)
+        self._lock = Lock()
+
+    @staticmethod
+    def encode(event_id, data, event=None):
+        """编码为一个SSE帧，data非str/bytes时以json序列化"""
+        if isinstance(data, bytes):
+            data = data.decode()
+        elif not isinstance(data, str):
+            data = compact_dumps(data)
+
+        lines = [f'id: {event_id}']
+        if event:
+            lines.append(f'event: {event}')
+        lines.extend(f'data: {line}' for line in data.split('\n'))
+        return ('\n'.join(lines) + '\n\n').encode()
+
+    def publish(self, data, event=None):
+        """发布事件到所有订阅者，返回事件id"""
+        with self._lock:
+            event_id = next(self._ids)
+            frame = self.encode(event_id, data, event)
+            self.history.append((event_id, frame))
+            subscribers = list(self.subscribers)
+
+        slow = [s for s in subscribers if not s.put(frame)]
+        for subscription in slow:
+            self.unsubscribe(subscription)
+            subscription.close()
+        self.evicted += len(slow)
+        return event_id
+
+    def subscribe(self, last_event_id=None):
+        """新增订阅者，给出last_event_id时先补发其后的历史事件"""
+        subscription = Subscription(self, self.queue_size)
+        with self._lock:
+            if last_event_id is not None:
+                missed = [frame for i, frame in self.history if i > last_event_id]
+                subscription.queue.extend(missed[-self.queue_size:])
+            self.subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self.subscribers.discard(subscription)
+
+    def stream(self, last_event_id=None):
+        """生成SSE响应，默认从请求头 Last-Event-ID 得到断点"""
+        if last_event_id is None:
+            last_event_id = request.headers.get('Last-Event-ID', type=int)
+        return EventStream(self.subscribe(last_event_id), self.keepalive)